@@ -2,6 +2,10 @@
 import random
 import os
 import csv
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import util.dictionary
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 EN_FILE = os.path.join(BASE_DIR, "dataset/parallel/en-es.txt/tico-19.en-es.en")
@@ -13,24 +17,15 @@ CROSS_PROB = 1.0
 RATIO = 0.6
 
 def load_dictionary(dict_path):
-    mapping = {}
-    with open(dict_path, "r", encoding="utf-8") as f:
-        for line in f:
-            parts = line.strip().split()
-            if len(parts) >= 2:
-                src, tgt = parts[0], parts[1]
-                src_lower = src.lower()
-                if src_lower not in mapping:
-                    mapping[src_lower] = []
-                mapping[src_lower].append(tgt)
-    return mapping
+    # lowercased view over the shared compiled dictionary (see util/dictionary.py)
+    return util.dictionary.load(dict_path, lower=True)
 
 def cross(word, dict_list, cross_prob):
     if random.random() < cross_prob:
         lan = 1  # 0 = zh, 1 = es
-        word_lower = word.lower()
-        if word_lower in dict_list[lan]:
-            return random.choice(dict_list[lan][word_lower])
+        cands = dict_list[lan].get(word.lower())
+        if cands:
+            return random.choice(cands)
     return word
 
 def cross_str(sentence, dict_list, cross_prob, ratio):
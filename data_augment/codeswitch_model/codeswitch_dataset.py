@@ -1,11 +1,18 @@
 import datasets                             # type: ignore    
 import random
 
+import numpy as np                          # type: ignore
+import torch                                # type: ignore
+
 from torch.utils.data import Dataset        # type: ignore
 from transformers import MT5Tokenizer       # type: ignore
 
+import os
+import sys
 import pandas as pd                         # type: ignore
-from indic_transliteration import sanscript # type: ignore
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from util.transliterate import Transliterator
 
 def romanize_hindi():
     '''
@@ -14,15 +21,27 @@ def romanize_hindi():
     df = pd.read_csv("../dataset/CSPref/train-00000-of-00001.tsv", sep="\t", on_bad_lines='skip')
     column_name = df.columns[1]  # original_l2 - hindi script text
 
+    transliterator = Transliterator()
     df_romanized = pd.DataFrame({
-        "romanized_text": df[column_name].astype(str).apply(
-            lambda x: sanscript.transliterate(x, sanscript.DEVANAGARI, sanscript.ITRANS) if isinstance(x, str) else x
-        )
+        "romanized_text": transliterator.romanize_batch(df[column_name].astype(str))
     })
+    transliterator.close()
 
     df_romanized.to_csv("../dataset/CSPref/romanized_cspref_train.tsv", sep="\t", index=False)
 
 
+def load_cspref_documents():
+    '''
+    Load the cspref train split with Hindi romanized
+    '''
+    data = datasets.load_dataset("garrykuwanto/cspref")['train']
+    # romanized through the shared on-disk cache, so only new sentences pay for transliteration
+    transliterator = Transliterator()
+    documents = transliterator.romanize_batch(datapoint['original_l2'] for datapoint in data)
+    transliterator.close()
+    return documents
+
+
 class CodeswitchDataset(Dataset):
   def __init__(self, tokenizer, block_size):
     self.data = []
@@ -32,8 +51,7 @@ class CodeswitchDataset(Dataset):
     self.max_length = block_size
 
     # hugging face dataset 
-    self.data = datasets.load_dataset("garrykuwanto/cspref")['train']
-    self.data = [sanscript.transliterate(datapoint['original_l2'], sanscript.DEVANAGARI, sanscript.ITRANS) for datapoint in self.data]
+    self.data = load_cspref_documents()
     
     # add masking to the dataset -- partially taken from A4
     chars = set()
@@ -103,8 +121,101 @@ class CodeswitchDataset(Dataset):
         return {
            "input_ids": encoding["input_ids"].squeeze(),
            "attention_mask": encoding["attention_mask"].squeeze(),
-           "labels": labels["input_ids"].squeeze() }            
-  
+           "labels": labels["input_ids"].squeeze() }
+
+
+class PretokenizedCodeswitchDataset(Dataset):
+  '''
+  Token-level variant of CodeswitchDataset: every document is tokenized once
+  with the fast tokenizer into a flat int32 buffer (with each token's start
+  character), and the A4 span masking is drawn in characters and snapped to
+  token boundaries. Use with collate_dynamic_padding.
+  '''
+  def __init__(self, tokenizer, block_size, documents=None, tokenize_batch=1024):
+    self.MASK_CHAR = "\u2047"
+    self.tokenizer = tokenizer
+    self.block_size = block_size
+    self.max_length = block_size
+
+    documents = load_cspref_documents() if documents is None else documents
+    lengths = []
+    chunks = []
+    start_chunks = []
+    for i in range(0, len(documents), tokenize_batch):
+      encoded = tokenizer(documents[i : i + tokenize_batch], add_special_tokens=False, return_offsets_mapping=True)
+      lengths.extend(len(x) for x in encoded["input_ids"])
+      chunks.extend(np.asarray(x, dtype=np.int32) for x in encoded["input_ids"])
+      start_chunks.extend(np.asarray([bgn for bgn, _ in x], dtype=np.int32) for x in encoded["offset_mapping"])
+    self.tokens = np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.int32)
+    self.starts = np.concatenate(start_chunks) if start_chunks else np.zeros(0, dtype=np.int32)
+    self.offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=self.offsets[1:])
+
+    # the mask id as it appears inside the character version's string (after a
+    # character, so SentencePiece adds no word-start piece); it must be one id
+    context = tokenizer("a", add_special_tokens=False)["input_ids"]
+    with_mask = tokenizer("a" + self.MASK_CHAR, add_special_tokens=False)["input_ids"]
+    assert with_mask[:len(context)] == context and len(with_mask) == len(context) + 1, \
+      "mask character does not tokenize to a single id: {}".format(with_mask[len(context):])
+    self.mask_ids = np.asarray(with_mask[len(context):], dtype=np.int32)
+    self.eos_ids = np.asarray([tokenizer.eos_token_id], dtype=np.int32)
+    self.pad_id = tokenizer.pad_token_id
+
+
+  def __len__(self):
+    return len(self.offsets) - 1
+
+
+  def lengths(self):
+    # upper bound on the example length; the truncation point is drawn per item
+    return np.minimum(np.diff(self.offsets), self.max_length)
+
+
+  def __getitem__(self, idx):
+        doc = self.tokens[self.offsets[idx] : self.offsets[idx + 1]]
+        starts = self.starts[self.offsets[idx] : self.offsets[idx + 1]]
+
+        # same truncation and span distribution as CodeswitchDataset, drawn in characters
+        truncated_len = random.randint(4, self.block_size*7 // 8)
+
+        lower_bound = 1
+        upper_bound = truncated_len // 2 - 1
+
+        masked_len = random.randint(lower_bound, upper_bound)
+        masked_start = (truncated_len - masked_len) // 2 - 1
+
+        # character positions -> token boundaries (a token belongs to the span it starts in)
+        cut, span_bgn, span_end = np.searchsorted(starts, [truncated_len, masked_start, masked_start + masked_len])
+        prefix = doc[:span_bgn]
+        masked_content = doc[span_bgn:span_end]
+        suffix = doc[span_end:cut]
+
+        masked = np.concatenate([prefix, self.mask_ids, suffix, self.mask_ids, masked_content])
+
+        # shifted pair as in the character version, truncated to leave room for </s>
+        x = np.concatenate([masked[:-1][:self.max_length - 1], self.eos_ids])
+        y = np.concatenate([masked[1:][:self.max_length - 1], self.eos_ids])
+
+        return {
+           "input_ids": torch.from_numpy(x.astype(np.int64)),
+           "labels": torch.from_numpy(y.astype(np.int64)) }
+
+
+def collate_dynamic_padding(batch, pad_id=0):
+  '''
+  Pad a list of variable-length examples to the longest one in the batch
+  '''
+  max_len = max(max(len(ex["input_ids"]), len(ex["labels"])) for ex in batch)
+  input_ids = torch.full((len(batch), max_len), pad_id, dtype=torch.long)
+  attention_mask = torch.zeros((len(batch), max_len), dtype=torch.long)
+  labels = torch.full((len(batch), max_len), -100, dtype=torch.long)
+  for i, ex in enumerate(batch):
+    n, m = len(ex["input_ids"]), len(ex["labels"])
+    input_ids[i, :n] = ex["input_ids"]
+    attention_mask[i, :n] = 1
+    labels[i, :m] = ex["labels"]
+  return {"input_ids": input_ids, "attention_mask": attention_mask, "labels": labels}
+
 
 if __name__ == '__main__':
   #tokenizer = MT5Tokenizer.from_pretrained("google/mt5-small")
@@ -0,0 +1,210 @@
+import json
+import math
+import os
+import sys
+import time
+
+import numpy as np                          # type: ignore
+import torch                                # type: ignore
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from util.generation_cache import generate_cached
+
+# Batched codeswitched generation with the step-2 mT5 model. Inputs are sorted
+# by token length so each generate() call pads as little as possible, and the
+# outputs are put back in input order. generate_file streams a text file in
+# chunks of lines; after every chunk the output is flushed and a checkpoint
+# (input offset, output size) is saved next to it, so a killed job that is
+# restarted truncates the output to the last checkpoint and carries on.
+# DedupGenerator wraps any batch generator so that each distinct input is
+# generated once per run (XNLI repeats every premise for ~3 hypotheses); given
+# a length_fn it sorts each call's misses by token length before chunking, so
+# callers that pass windows of SORT_WINDOW batches get tightly padded batches.
+# Both can sit on a util.generation_cache.GenerationCache, which memoizes
+# outputs on disk across runs. quantize_for_cpu is the CPU profile: dynamic
+# int8 linears, usually paired with greedy decoding and max_length_ratio,
+# which caps each sentence's new tokens relative to its own input length:
+# batches only group rows with the same budget, so a sentence's output never
+# depends on which other sentences share its batch (and can be cached).
+
+SORT_WINDOW = 8
+
+
+def token_lengths(tokenizer, texts):
+    return [len(ids) for ids in tokenizer(list(texts))["input_ids"]]
+
+
+def quantize_for_cpu(model, threads=None):
+    '''
+    Dynamic int8 quantization of every nn.Linear (weights int8, activations quantized on the fly), for CPU inference
+    '''
+    if threads:
+        torch.set_num_threads(threads)
+    model = model.to("cpu").eval()
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def new_token_budget(max_new_tokens, max_length_ratio, input_length):
+    if max_length_ratio is None:
+        return max_new_tokens
+    return max(1, min(max_new_tokens, math.ceil(max_length_ratio * input_length)))
+
+
+def budget_batches(order, lengths, batch_size, max_new_tokens, max_length_ratio):
+    '''
+    Split length-sorted rows into batches of at most batch_size rows that share one new-token budget
+    '''
+    batches = []
+    rows, budget = [], None
+    for row in order:
+        row_budget = new_token_budget(max_new_tokens, max_length_ratio, lengths[row])
+        if rows and (len(rows) == batch_size or row_budget != budget):
+            batches.append((rows, budget))
+            rows = []
+        rows.append(row)
+        budget = row_budget
+    if rows:
+        batches.append((rows, budget))
+    return batches
+
+
+def generate_texts(model, tokenizer, texts, batch_size=32, num_beams=5, max_new_tokens=128, max_input_length=None,
+                   max_length_ratio=None, cache=None):
+    '''
+    Generate one output per input text, batched over length-sorted inputs; with a cache only misses are generated
+    '''
+    if cache is not None:
+        generation_kwargs = {"num_beams": num_beams, "max_new_tokens": max_new_tokens, "max_input_length": max_input_length}
+        if max_length_ratio is not None:
+            # per-row caps; entries from the earlier per-batch cap are not reused
+            generation_kwargs.update(max_length_ratio=max_length_ratio, length_cap="row")
+        return generate_cached(cache, texts, generation_kwargs,
+                               lambda missing: generate_texts(model, tokenizer, missing, batch_size, num_beams,
+                                                              max_new_tokens, max_input_length, max_length_ratio))
+    if not texts:
+        return []
+    device = next(model.parameters()).device
+    truncation = max_input_length is not None
+    encoded = tokenizer(list(texts), truncation=truncation, max_length=max_input_length)["input_ids"]
+    lengths = np.array([len(ids) for ids in encoded])
+    pad_id = tokenizer.pad_token_id or 0
+    outputs = [None] * len(texts)
+
+    model.eval()
+    order = np.argsort(lengths, kind="stable")
+    for rows, budget in budget_batches(order, lengths, batch_size, max_new_tokens, max_length_ratio):
+        rows = np.asarray(rows)
+        width = lengths[rows].max()
+        input_ids = np.full((len(rows), width), pad_id, dtype=np.int64)
+        for i, row in enumerate(rows):
+            input_ids[i, : lengths[row]] = encoded[row]
+        attention_mask = (np.arange(width)[None, :] < lengths[rows][:, None]).astype(np.int64)
+
+        with torch.no_grad():
+            generated = model.generate(input_ids=torch.from_numpy(input_ids).to(device),
+                                       attention_mask=torch.from_numpy(attention_mask).to(device),
+                                       num_beams=num_beams, early_stopping=num_beams > 1,
+                                       max_new_tokens=budget)
+        for row, text in zip(rows, tokenizer.batch_decode(generated, skip_special_tokens=True)):
+            outputs[row] = text
+    return outputs
+
+
+class DedupGenerator(object):
+    '''
+    Call generate_fn(texts) only on inputs not seen before in this run; outputs are returned in input order
+    '''
+    def __init__(self, generate_fn, batch_size=None, length_fn=None):
+        self.generate_fn = generate_fn
+        self.batch_size = batch_size
+        self.length_fn = length_fn
+        self.memo = {}
+        self.requests = 0
+        self.hits = 0
+
+    def __call__(self, texts):
+        # unique unseen inputs, in first-seen order
+        todo = list(dict.fromkeys(text for text in texts if text not in self.memo))
+        if self.length_fn is not None and len(todo) > 1:
+            lengths = self.length_fn(todo)
+            todo = [todo[i] for i in np.argsort(lengths, kind="stable")]
+        self.requests += len(texts)
+        self.hits += len(texts) - len(todo)
+        step = self.batch_size or max(len(todo), 1)
+        for bgn in range(0, len(todo), step):
+            batch = todo[bgn : bgn + step]
+            for text, output in zip(batch, self.generate_fn(batch)):
+                self.memo[text] = output
+        return [self.memo[text] for text in texts]
+
+    def hit_rate(self):
+        return self.hits / max(self.requests, 1)
+
+
+def read_chunks(filename, offset, chunk_lines):
+    '''
+    Yield (lines, input offset after the chunk) from a byte offset on
+    '''
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        lines = []
+        for line in f:
+            lines.append(line.decode('utf-8'))
+            if len(lines) == chunk_lines:
+                yield lines, f.tell()
+                lines = []
+        if lines:
+            yield lines, f.tell()
+
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_checkpoint(path, state):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+def generate_file(model, tokenizer, filename, output_filename, chunk_lines=1024, parse_line=None, cache=None,
+                  **generation_options):
+    '''
+    Generate one output line per input line, resumable through output_filename + ".ckpt"
+    '''
+    ckpt_path = output_filename + ".ckpt"
+    stat = os.stat(filename)
+    source = {"input": os.path.abspath(filename), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+              "options": generation_options}
+    state = load_checkpoint(ckpt_path)
+    if state is None or state["source"] != source or not os.path.exists(output_filename):
+        state = {"source": source, "offset": 0, "out_size": 0, "lines": 0}
+    elif state["lines"]:
+        print(f"Resuming after {state['lines']} lines")
+
+    start = time.time()
+    done = 0
+    with open(output_filename, 'a', encoding='utf-8') as out:
+        # drop anything written after the last checkpoint
+        out.truncate(state["out_size"])
+        out.seek(state["out_size"])
+        for lines, offset in read_chunks(filename, state["offset"], chunk_lines):
+            texts = [parse_line(line) if parse_line else line.strip() for line in lines]
+            generated = generate_texts(model, tokenizer, texts, cache=cache, **generation_options)
+            out.writelines(text.replace('\n', ' ') + '\n' for text in generated)
+            out.flush()
+            os.fsync(out.fileno())
+            done += len(lines)
+            state.update(offset=offset, out_size=out.tell(), lines=state["lines"] + len(lines))
+            save_checkpoint(ckpt_path, state)
+            elapsed = time.time() - start
+            print(f"Generated {state['lines']} lines ({done / max(elapsed, 1e-9):.1f} sentences/s)")
+    if os.path.exists(ckpt_path):
+        os.remove(ckpt_path)
+    elapsed = time.time() - start
+    print(f"Generated {done} lines in {elapsed:.1f}s ({done / max(elapsed, 1e-9):.1f} sentences/s)")
+    return done
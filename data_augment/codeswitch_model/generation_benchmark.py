@@ -0,0 +1,80 @@
+import argparse
+import difflib
+import sys
+import time
+
+import numpy as np                          # type: ignore
+import torch                                # type: ignore
+
+from transformers import MT5ForConditionalGeneration, MT5Tokenizer # type: ignore
+from generation import generate_texts, quantize_for_cpu
+
+# Throughput of the CPU generation profiles against the fp32 beam-search
+# baseline, and how far their outputs drift from it: exact-match rate and mean
+# token-level similarity (difflib ratio over whitespace tokens). The last
+# profile (int8, greedy, length-capped) is the one step 3 uses with
+# --cpu_int8 --num_beams 1 --max_length_ratio; the run fails when its
+# similarity falls below --min_similarity.
+#
+#   python codeswitch_model/generation_benchmark.py --limit 200 --threads 8
+
+
+def agreement(outputs, reference):
+    exact = np.mean([a == b for a, b in zip(outputs, reference)])
+    similarity = np.mean([difflib.SequenceMatcher(None, a.split(), b.split()).ratio() for a, b in zip(outputs, reference)])
+    return exact, similarity
+
+
+def timed_generate(model, tokenizer, texts, **options):
+    start = time.time()
+    outputs = generate_texts(model, tokenizer, texts, **options)
+    return outputs, len(texts) / max(time.time() - start, 1e-9)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--checkpoint", type=str, default="mt5_finetuned_5.pth")
+    parser.add_argument("--input_file", type=str, default="dataset/enghinglish/test.txt")
+    parser.add_argument("--limit", type=int, default=200, help="number of input lines")
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--num_beams", type=int, default=5, help="beam width of the fp32 baseline and the int8 beam profile")
+    parser.add_argument("--max_new_tokens", type=int, default=128)
+    parser.add_argument("--max_length_ratio", type=float, default=1.5)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--min_similarity", type=float, default=0.9)
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    model = MT5ForConditionalGeneration.from_pretrained("google/mt5-small")
+    model.load_state_dict(torch.load(args.checkpoint, map_location="cpu"))
+    model.eval()
+    tokenizer = MT5Tokenizer.from_pretrained("google/mt5-small")
+    with open(args.input_file, encoding="utf-8") as f:
+        texts = [line.strip() for _, line in zip(range(args.limit), f)]
+
+    common = dict(batch_size=args.batch_size, max_new_tokens=args.max_new_tokens)
+    reference, baseline_speed = timed_generate(model, tokenizer, texts, num_beams=args.num_beams, **common)
+    quantized = quantize_for_cpu(model, args.threads)
+    profiles = [
+        ("fp32 greedy", model, dict(num_beams=1)),
+        ("int8 beam", quantized, dict(num_beams=args.num_beams)),
+        ("int8 greedy", quantized, dict(num_beams=1)),
+        ("int8 greedy + length cap", quantized, dict(num_beams=1, max_length_ratio=args.max_length_ratio)),
+    ]
+
+    print(f"{len(texts)} sentences, {torch.get_num_threads()} threads")
+    print(f"{'profile':<26}{'sent/s':>9}{'speedup':>9}{'exact':>8}{'similarity':>12}")
+    print(f"{'fp32 beam ' + str(args.num_beams):<26}{baseline_speed:>9.2f}{1.0:>9.2f}{1.0:>8.2f}{1.0:>12.3f}")
+    for name, profile_model, options in profiles:
+        outputs, speed = timed_generate(profile_model, tokenizer, texts, **options, **common)
+        exact, similarity = agreement(outputs, reference)
+        print(f"{name:<26}{speed:>9.2f}{speed / baseline_speed:>9.2f}{exact:>8.2f}{similarity:>12.3f}")
+
+    if similarity < args.min_similarity:
+        print(f"CPU profile similarity {similarity:.3f} is below --min_similarity {args.min_similarity}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
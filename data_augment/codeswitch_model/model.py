@@ -2,19 +2,35 @@ import argparse
 import torch # type: ignore
 import datasets # type: ignore
 
-from transformers import MT5ForConditionalGeneration, MT5Tokenizer # type: ignore
+import functools
+import os
+import sys
+
+from transformers import MT5ForConditionalGeneration, MT5Tokenizer, MT5TokenizerFast # type: ignore
 from trainer import Trainer, TrainerConfig
-from parsed_dataset import ParsedDataset
+from parsed_dataset import ParsedDataset, collate_trim_padding
 
-from codeswitch_dataset import CodeswitchDataset
+from codeswitch_dataset import CodeswitchDataset, PretokenizedCodeswitchDataset, collate_dynamic_padding
+from generation import SORT_WINDOW, DedupGenerator, budget_batches, generate_file, quantize_for_cpu, token_lengths
 from torch.utils.tensorboard import SummaryWriter               # type: ignore
 
-def finetune_mT5_codeswitched():
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from util.distributed import barrier, cleanup, init_distributed, is_main_process
+from util.generation_cache import GenerationCache, generate_cached, weights_fingerprint
+
+def finetune_mT5_codeswitched(**train_options):
     '''
     STEP 1: Finetune on codeswitched data
     '''
-    tokenizer = MT5Tokenizer.from_pretrained("google/mt5-small")
-    dataset = CodeswitchDataset(tokenizer=tokenizer, block_size=128)
+    # tokenized once up front; span masking on token ids, padding per batch
+    tokenizer = MT5TokenizerFast.from_pretrained("google/mt5-small")
+
+    # rank 0 downloads and romanizes first (filling the transliteration cache) under torchrun
+    if not is_main_process():
+        barrier()
+    dataset = PretokenizedCodeswitchDataset(tokenizer=tokenizer, block_size=128)
+    if is_main_process():
+        barrier()
     model = MT5ForConditionalGeneration.from_pretrained("google/mt5-small")
 
     # device = torch.device("cuda")
@@ -33,10 +49,12 @@ def finetune_mT5_codeswitched():
         betas = (0.9, 0.999), 
         weight_decay = 0.01,     # avoid overregularization
         lr_decay = True,
-        warmup_tokens = 1e6,
-        final_tokens = 10e9,
+        warmup_tokens = 1e6,     # real tokens; the fixed-128 padding used to count 1024 per batch,
+        final_tokens = 10e9,     # so warmup now spans several times more steps
         num_workers = 4, 
-        ckpt_path="mt5_intermediate_finetuned_ckpt.pth"
+        collate_fn = functools.partial(collate_dynamic_padding, pad_id=tokenizer.pad_token_id),
+        ckpt_path="mt5_intermediate_finetuned_ckpt.pth",
+        **train_options          # precision / grad_accum_steps / gradient_checkpointing / sync_free from the command line
     )
 
     trainer = Trainer(
@@ -48,21 +66,27 @@ def finetune_mT5_codeswitched():
     )
 
     trainer.train()
-    torch.save(model.state_dict(), 'mt5_intermediate_finetuned_5.pth')
+    if is_main_process():
+        torch.save(model.state_dict(), 'mt5_intermediate_finetuned_5.pth')
     
 
-def finetune_mT5_codeswitched_generation(dataset, label_dataset):
+def finetune_mT5_codeswitched_generation(dataset, label_dataset, **train_options):
     '''
     STEP 2: Finetune for codeswitch generation on the parsed dataset
     '''
     model = MT5ForConditionalGeneration.from_pretrained("google/mt5-small")
-    model.load_state_dict(torch.load('mt5_intermediate_finetuned_5.pth'))   # uncomment for gpu
+    model.load_state_dict(torch.load('mt5_intermediate_finetuned_5.pth', map_location="cpu"))   # the Trainer moves it to the device
     # model.load_state_dict(torch.load('mt5_intermediate_finetuned.pth', map_location=torch.device('cpu')))   # uncomment for cpu
   
-    tokenizer = MT5Tokenizer.from_pretrained("google/mt5-small")
+    tokenizer = MT5TokenizerFast.from_pretrained("google/mt5-small")   # batch-tokenizes each split once, cached on disk
 
+    # rank 0 fills the tokenization cache first under torchrun
+    if not is_main_process():
+        barrier()
     dataset = ParsedDataset(dataset, label_dataset, tokenizer=tokenizer)
     dev_dataset = ParsedDataset(dataset, label_dataset, tokenizer=tokenizer, validation=True)
+    if is_main_process():
+        barrier()
 
     tconf = TrainerConfig(
         max_epochs=150,    
@@ -72,7 +96,9 @@ def finetune_mT5_codeswitched_generation(dataset, label_dataset):
         betas = (0.9, 0.98),           
         weight_decay = 0.01,   # Regularization to prevent overfitting
         num_workers=4,      # change to 4 when running on gpu (0 for cpu)
-        ckpt_path="mt5_finetuned_ckpt.pth"
+        ckpt_path="mt5_finetuned_ckpt.pth",
+        collate_fn=collate_trim_padding,   # trims each batch to its longest example
+        **train_options       # e.g. --grad_accum_steps 2 for an effective batch of 16 without the OOM
     )
 
     trainer = Trainer(
@@ -84,7 +110,8 @@ def finetune_mT5_codeswitched_generation(dataset, label_dataset):
     )
 
     trainer.train()
-    torch.save(model.state_dict(), 'mt5_finetuned_5.pth')
+    if is_main_process():
+        torch.save(model.state_dict(), 'mt5_finetuned_5.pth')
 
 
 def generate_codeswitched_text(model, tokenizer, text):
@@ -99,113 +126,220 @@ def generate_codeswitched_text(model, tokenizer, text):
     return tokenizer.decode(outputs[0], skip_special_tokens=True)
 
 
-def generate_codeswitched_text_from_file(model, tokenizer, filename, output_filename):
+def annotated_line(line):
     '''
-    Generate codeswitched text from file
+    Model input for a line of the annotated dataset
     '''
+    sentence, pos_tags, dep_rels = line.rstrip('\n').split('\t')
+    return sentence + ' <POS> ' + pos_tags + ' <DEP> ' + dep_rels
 
-    with open(filename, 'r') as file:
-        lines = file.readlines()
-        for line in lines:
-            line = line.strip()
-             
-            # for annotated dataset
-            # sentence, pos_tags, dep_rels = line.split('\t')
-            # line = sentence + ' <POS> ' + pos_tags + ' <DEP> ' + dep_rels
 
-            with open(output_filename, 'w') as out:
-                codeswitched_line = generate_codeswitched_text(model, tokenizer, line)
-                out.write(codeswitched_line + '\n')
+def generate_codeswitched_text_from_file(model, tokenizer, filename, output_filename, batch_size=32, num_beams=5,
+                                         max_new_tokens=128, max_length_ratio=None, chunk_lines=1024, annotated=False,
+                                         cache=None):
+    '''
+    Generate codeswitched text from file, one output line per input line (resumes an interrupted run)
+    '''
+    # for annotated dataset: annotated=True
+    return generate_file(model, tokenizer, filename, output_filename, chunk_lines=chunk_lines,
+                         parse_line=annotated_line if annotated else None, cache=cache,
+                         batch_size=batch_size, num_beams=num_beams, max_new_tokens=max_new_tokens,
+                         max_length_ratio=max_length_ratio)
 
 
-def generate_codeswitched_text_batch(model, tokenizer, texts, max_length=128):
+def generate_codeswitched_text_batch(model, tokenizer, texts, max_length=128, cache=None, num_beams=1,
+                                     max_length_ratio=None):
     '''
     Generate codeswitched text for a batch of inputs to speed up runtime
     '''
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    model.to(device)
+    if cache is not None:
+        # bulk lookup; only the misses reach the model
+        generation_kwargs = {"max_length": max_length}
+        if num_beams != 1 or max_length_ratio is not None:
+            generation_kwargs.update(num_beams=num_beams, max_length_ratio=max_length_ratio)
+        if max_length_ratio is not None:
+            # per-row caps; entries from the earlier per-batch cap are not reused
+            generation_kwargs["length_cap"] = "row"
+        return generate_cached(cache, texts, generation_kwargs,
+                               lambda missing: generate_codeswitched_text_batch(model, tokenizer, missing, max_length,
+                                                                                num_beams=num_beams,
+                                                                                max_length_ratio=max_length_ratio))
+
+    # the model stays where the caller put it (a GPU, or the CPU for the int8 profile)
+    device = next(model.parameters()).device
     
     inputs = tokenizer(texts, return_tensors="pt", padding=True, truncation=True, max_length=max_length)
     inputs = {key: val.to(device) for key, val in inputs.items()}
 
-    with torch.no_grad():
-        with torch.autocast("cuda"):  
-            outputs = model.generate(**inputs, max_length=max_length)
-
-    generated_texts = tokenizer.batch_decode(outputs, skip_special_tokens=True)
+    if max_length_ratio is None:
+        # max_length counts the decoder start token
+        with torch.no_grad():
+            with torch.autocast("cuda", enabled=device.type == "cuda"):
+                outputs = model.generate(**inputs, num_beams=num_beams, max_length=max_length)
+        return tokenizer.batch_decode(outputs, skip_special_tokens=True)
+
+    # each row is capped by its own length: one generate call per group of rows with the same budget
+    lengths = inputs["attention_mask"].sum(dim=1).tolist()
+    order = sorted(range(len(texts)), key=lambda row: lengths[row])
+    generated_texts = [None] * len(texts)
+    for rows, budget in budget_batches(order, lengths, len(texts), max_length - 1, max_length_ratio):
+        width = max(lengths[row] for row in rows)
+        index = torch.tensor(rows, device=device)
+        with torch.no_grad():
+            with torch.autocast("cuda", enabled=device.type == "cuda"):
+                outputs = model.generate(input_ids=inputs["input_ids"][index, :width],
+                                         attention_mask=inputs["attention_mask"][index, :width],
+                                         num_beams=num_beams, max_new_tokens=budget)
+        for row, text in zip(rows, tokenizer.batch_decode(outputs, skip_special_tokens=True)):
+            generated_texts[row] = text
     return generated_texts
 
 
-def generate_codewitched_text_from_dataset(model, tokenizer, output_filename, batch_size=64):
+def sample_xnli(fraction=0.2, seed=None):
     '''
-    Generate codeswitched text from dataset
+    Random fraction of XNLI train (a new sample every run unless seeded)
     '''
     dataset = datasets.load_dataset("facebook/xnli", "en", split="train")
-    reduced_length = int(len(dataset) * 0.2)
-    dataset = dataset.shuffle()
-    dataset = dataset.select(range(reduced_length))
+    reduced_length = int(len(dataset) * fraction)
+    dataset = dataset.shuffle(seed=seed)
+    return dataset.select(range(reduced_length))
+
+
+def write_xnli_groundtruth(dataset, filename='dataset/groundtruth/randomized_reduced_xnli.txt'):
+    '''
+    Premise and hypothesis lines, aligned with the codeswitched output
+    '''
+    with open(filename, 'w') as label_out:
+        for datapoint in dataset:
+            label_out.write(datapoint['premise'] + '\n')
+            label_out.write(datapoint['hypothesis'] + '\n')
+
+
+def generate_codewitched_text_from_dataset(model, tokenizer, output_filename, batch_size=64, cache=None,
+                                           **generation_options):
+    '''
+    Generate codeswitched text from dataset
+    '''
+    dataset = sample_xnli()
 
     print('Dataset loaded. Generating codeswitched text...')
 
-    with open(output_filename, 'w') as out:
-        with open('dataset/groundtruth/randomized_reduced_xnli.txt', 'w') as label_out:
-            batch_premises, batch_hypotheses = [], []
+    # premises and hypotheses go through one queue; a premise shared by several hypotheses is generated once,
+    # and the misses of each window of SORT_WINDOW batches are length-sorted before batching
+    generate = DedupGenerator(functools.partial(generate_codeswitched_text_batch, model, tokenizer, cache=cache,
+                                                **generation_options),
+                              batch_size=batch_size, length_fn=functools.partial(token_lengths, tokenizer))
+
+    write_xnli_groundtruth(dataset)
 
-            for idx, datapoint in enumerate(dataset):
-                batch_premises.append(datapoint['premise'])
-                batch_hypotheses.append(datapoint['hypothesis'])
-                label_out.write(datapoint['premise'] + '\n')
-                label_out.write(datapoint['hypothesis'] + '\n')
+    with open(output_filename, 'w') as out:
+        batch_texts = []
 
-                # Process in batches
-                if len(batch_premises) == batch_size:
-                    codeswitched_premises = generate_codeswitched_text_batch(model, tokenizer, batch_premises)
-                    codeswitched_hypotheses = generate_codeswitched_text_batch(model, tokenizer, batch_hypotheses)
+        for idx, datapoint in enumerate(dataset):
+            batch_texts.append(datapoint['premise'])
+            batch_texts.append(datapoint['hypothesis'])
 
-                    for cs_premise, cs_hypothesis in zip(codeswitched_premises, codeswitched_hypotheses):
-                        out.write(cs_premise + '\n')
-                        out.write(cs_hypothesis + '\n')
+            # Process in windows of batches, written back in premise / hypothesis order
+            if len(batch_texts) == 2 * batch_size * SORT_WINDOW:
+                for codeswitched in generate(batch_texts):
+                    out.write(codeswitched + '\n')
+                batch_texts = []
 
-                    batch_premises, batch_hypotheses = [], []
+            if idx % (batch_size * 100) == 0:
+                print(f"Processed {idx} examples (cache hit rate {generate.hit_rate():.1%})")
 
-                if idx % (batch_size * 100) == 0:
-                    print(f"Processed {idx} examples")
+        # Process remaining examples (if batch size doesn't divide dataset size)
+        if batch_texts:
+            for codeswitched in generate(batch_texts):
+                out.write(codeswitched + '\n')
 
-            # Process remaining examples (if batch size doesn't divide dataset size)
-            if batch_premises:
-                codeswitched_premises = generate_codeswitched_text_batch(model, tokenizer, batch_premises)
-                codeswitched_hypotheses = generate_codeswitched_text_batch(model, tokenizer, batch_hypotheses)
-                for cs_premise, cs_hypothesis in zip(codeswitched_premises, codeswitched_hypotheses):
-                    out.write(cs_premise + '\n')
-                    out.write(cs_hypothesis + '\n')
+    print(f"Generated {len(generate.memo)} unique sentences for {generate.requests} inputs "
+          f"(cache hit rate {generate.hit_rate():.1%})")
+    if cache is not None:
+        print(f"Generation cache: {cache.hits} of {cache.requests} unique sentences from disk ({cache.hit_rate():.1%})")
 
 
-def generate_codeswitched_corpus():
+def load_generation_model(use_cache=True, cpu_int8=False, threads=None):
     '''
-    STEP 3: Generate codeswitched corpus
+    Step-2 checkpoint for generation; returns (model, tokenizer, generation cache hash or None)
     '''
     model = MT5ForConditionalGeneration.from_pretrained("google/mt5-small")
-    model.load_state_dict(torch.load('mt5_finetuned_5.pth'))   # uncomment for gpu
-    # model.load_state_dict(torch.load('mt5_finetuned.pth', map_location=torch.device('cpu')))   # uncomment for cpu
+    model.load_state_dict(torch.load('mt5_finetuned_5.pth', map_location="cpu"))
+    # model.load_state_dict(torch.load('mt5_finetuned.pth', map_location=torch.device('cpu')))
     tokenizer = MT5Tokenizer.from_pretrained("google/mt5-small")
+
+    # outputs memoized on disk per checkpoint / input / decoding settings, reruns only generate new sentences
+    model_hash = weights_fingerprint(model) if use_cache else None
+    if cpu_int8:
+        # CPU profile: int8 linears, best with --num_beams 1 and a --max_length_ratio cap
+        model = quantize_for_cpu(model, threads)
+        model_hash = model_hash and model_hash + ":int8"
+    else:
+        model.to("cuda" if torch.cuda.is_available() else "cpu")
+    return model.eval(), tokenizer, model_hash
+
+
+def generate_codeswitched_corpus(input_file=None, output_file=None, use_cache=True, cpu_int8=False, threads=None,
+                                 **generation_options):
+    '''
+    STEP 3: Generate codeswitched corpus
+    '''
+    model, tokenizer, model_hash = load_generation_model(use_cache, cpu_int8, threads)
+    cache = GenerationCache(model_hash) if use_cache else None
+
+    # unset options keep each path's own defaults
+    generation_options = {k: v for k, v in generation_options.items() if v is not None}
     
-    # generate_codeswitched_text_from_file(model, tokenizer, "dataset/enghinglish/test.txt", "outputs/codeswitched_hinglish_en_test-3.txt")
-    generate_codewitched_text_from_dataset(model, tokenizer, "outputs/codeswitched_eval.txt")
+    # e.g. --input_file dataset/enghinglish/test.txt --output_file outputs/codeswitched_hinglish_en_test-3.txt
+    if input_file is not None:
+        generate_codeswitched_text_from_file(model, tokenizer, input_file, output_file, cache=cache, **generation_options)
+    else:
+        xnli_options = {k: v for k, v in generation_options.items() if k in ("num_beams", "max_length_ratio")}
+        generate_codewitched_text_from_dataset(model, tokenizer, "outputs/codeswitched_eval.txt", cache=cache,
+                                               **xnli_options)
+    if cache is not None:
+        cache.close()
 
 
 def main():
     argparser = argparse.ArgumentParser()
     argparser.add_argument("--step", type=str, help="step of ", required=True)
+    argparser.add_argument("--precision", choices=["fp32", "bf16"], default="fp32", help="steps 1-2: bf16 autocast")
+    argparser.add_argument("--grad_accum_steps", type=int, default=1, help="steps 1-2: batches per optimizer step")
+    argparser.add_argument("--gradient_checkpointing", action="store_true", help="steps 1-2: recompute activations in backward")
+    argparser.add_argument("--length_bucketing", action="store_true", help="steps 1-2: batch examples of similar length")
+    argparser.add_argument("--sync_free", action="store_true", help="steps 1-2: no per-step .item(); loss logged every log_every steps")
+    argparser.add_argument("--input_file", type=str, default=None, help="step 3: generate for each line of this file")
+    argparser.add_argument("--output_file", type=str, default=None, help="step 3: one generated line per input line")
+    argparser.add_argument("--num_beams", type=int, default=None, help="step 3: beam width, 1 = greedy (default 5 for --input_file, 1 for XNLI)")
+    argparser.add_argument("--max_new_tokens", type=int, default=128, help="step 3 --input_file: generated tokens per line")
+    argparser.add_argument("--gen_batch_size", type=int, default=32, help="step 3 --input_file: sentences per generate call")
+    argparser.add_argument("--no_generation_cache", action="store_true", help="step 3: do not read or fill dataset/generation.sqlite")
+    argparser.add_argument("--max_length_ratio", type=float, default=None, help="step 3: cap new tokens at this multiple of the input length")
+    argparser.add_argument("--cpu_int8", action="store_true", help="step 3: dynamic int8 quantization of the mT5 linears, on CPU")
+    argparser.add_argument("--threads", type=int, default=None, help="step 3 --cpu_int8: torch threads")
     args = argparser.parse_args()
+    if (args.input_file is None) != (args.output_file is None):
+        argparser.error("--input_file and --output_file go together")
+    train_options = dict(precision=args.precision, grad_accum_steps=args.grad_accum_steps,
+                         gradient_checkpointing=args.gradient_checkpointing, length_bucketing=args.length_bucketing,
+                         sync_free=args.sync_free)
 
     if args.step == "1":
-        finetune_mT5_codeswitched()
+        # steps 1-2 also run data-parallel under torchrun --nproc_per_node N codeswitch_model/model.py --step 1
+        init_distributed()
+        finetune_mT5_codeswitched(**train_options)
+        cleanup()
     elif args.step == "2":
         dataset = "dataset/annotated/annotated_hinglish_en.txt"
         label_dataset = "dataset/enghinglish/dev.txt"
-        finetune_mT5_codeswitched_generation(dataset, label_dataset)
+        init_distributed()
+        finetune_mT5_codeswitched_generation(dataset, label_dataset, **train_options)
+        cleanup()
     elif args.step == "3":
-        generate_codeswitched_corpus()
+        generate_codeswitched_corpus(args.input_file, args.output_file, not args.no_generation_cache, args.cpu_int8,
+                                     args.threads, batch_size=args.gen_batch_size, num_beams=args.num_beams,
+                                     max_new_tokens=args.max_new_tokens, max_length_ratio=args.max_length_ratio)
     else:
         print("Invalid step")
 
@@ -1,9 +1,37 @@
+import hashlib
+import os
+import sys
+
+import numpy as np # type: ignore
 import torch # type: ignore
 from torch.utils.data import Dataset, DataLoader # type: ignore
 from transformers import MT5Tokenizer # type: ignore
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from util.annotation_store import read_annotations
+
+
+def load_annotated_pairs(file_path, label_file_path):
+  '''
+  Pair each annotated sentence with its label from label_file_path (second TSV column)
+  '''
+  # blank lines are skipped on both sides, as read_annotations does
+  with open(label_file_path, "r", encoding="utf-8") as label_file:
+    labels = [line.strip().split("\t")[1] for line in label_file if line.strip()]
+  annotations = list(read_annotations(file_path))
+  if len(annotations) != len(labels):
+    raise ValueError("{} has {} annotated sentences but {} has {} labels".format(
+      file_path, len(annotations), label_file_path, len(labels)))
+
+  data = []
+  for (sentence, pos_tags, dep_rels), label in zip(annotations, labels):
+    input_text = sentence + ' <POS> ' + " ".join(pos_tags) + ' <DEP> ' + " ".join(dep_rels)
+    data.append([input_text, label])
+  return data
+
+
 class ParsedDataset(Dataset):
-  def __init__(self, file_path, label_file_path, tokenizer, validation=False, max_length=128):
+  def __init__(self, file_path, label_file_path, tokenizer, validation=False, max_length=128, cache_dir=None):
     self.data = []
     self.tokenizer = tokenizer
     self.max_length = max_length
@@ -15,44 +43,83 @@ class ParsedDataset(Dataset):
     
     self.data = [line.strip().split("\t")[:2] for line in self.data]
 
-    # experiments 1-3
-    # with open(file_path, "r", encoding="utf-8") as file:
-    #   with open(label_file_path, "r", encoding="utf-8") as label_file:
-    #         for line in file:
-    #             label = label_file.readline().strip().split("\t")[1]
-    #             parts = line.strip().split("\t")
-                
-    #             sentence, pos_tags, dep_rels = parts
-    #             input_text = sentence + ' <POS> ' + pos_tags + ' <DEP> ' + dep_rels
-
-    #             self.data.append([input_text, label])
+    # experiments 1-3: annotated sentences (TSV or .anno store) paired with dev.txt labels
+    # self.data = load_annotated_pairs(file_path, label_file_path)
   
 
-  def __len__(self):
-    return len(self.data)
+    self.input_ids, self.attention_mask, self.labels = self.load_or_encode(filename, cache_dir)
 
 
-  def __getitem__(self, idx):
-    input_text, label = self.data[idx]
+  def load_or_encode(self, filename, cache_dir):
+    '''
+    Tokenize the whole split once into padded int32 arrays, cached on disk
+    '''
+    cache_dir = cache_dir or os.path.join(os.path.dirname(filename), "cache")
+    stat = os.stat(filename)
+    key = "{}|{}|{}|{}|{}".format(os.path.abspath(filename), stat.st_size, stat.st_mtime_ns,
+                                  getattr(self.tokenizer, "name_or_path", ""), self.max_length)
+    cache_file = os.path.join(cache_dir, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".npz")
+    if os.path.exists(cache_file):
+      arrays = np.load(cache_file)
+      return arrays["input_ids"], arrays["attention_mask"], arrays["labels"]
+
+    inputs = [input_text for input_text, _ in self.data]
+    targets = [label for _, label in self.data]
     encoding = self.tokenizer(
-       input_text, max_length=self.max_length, padding="max_length", truncation=True, return_tensors="pt"
+        inputs, max_length=self.max_length, padding="max_length", truncation=True, return_tensors="np"
     )
-
     label_encoding = self.tokenizer(
-        label, max_length=self.max_length, padding="max_length", truncation=True, return_tensors="pt"
+        targets, max_length=self.max_length, padding="max_length", truncation=True, return_tensors="np"
     )
-    
+    input_ids = encoding["input_ids"].astype(np.int32)
+    attention_mask = encoding["attention_mask"].astype(np.int32)
+    labels = label_encoding["input_ids"].astype(np.int32)
+    labels[label_encoding["attention_mask"] == 0] = -100   # padding is ignored by the loss
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_file = cache_file + ".tmp.npz"
+    np.savez(tmp_file, input_ids=input_ids, attention_mask=attention_mask, labels=labels)
+    os.replace(tmp_file, cache_file)
+    return input_ids, attention_mask, labels
+
+
+  def __len__(self):
+    return len(self.input_ids)
+
+
+  def lengths(self):
+    # tokens per example after collate_trim_padding, for length-bucketed batching
+    return np.maximum(self.attention_mask.sum(axis=1), (self.labels != -100).sum(axis=1))
+
+
+  def __getitem__(self, idx):
+    # views into the pre-tokenized arrays, no tokenizer call per item
     return {
-            "input_ids": encoding["input_ids"].squeeze(),
-            "attention_mask": encoding["attention_mask"].squeeze(),
-            "labels": label_encoding["input_ids"].squeeze()       
+            "input_ids": torch.from_numpy(self.input_ids[idx]),
+            "attention_mask": torch.from_numpy(self.attention_mask[idx]),
+            "labels": torch.from_numpy(self.labels[idx])
         }
 
 
+def collate_trim_padding(batch):
+  '''
+  Stack a batch and trim the columns that are padding for every example
+  '''
+  input_ids = torch.stack([ex["input_ids"] for ex in batch])
+  attention_mask = torch.stack([ex["attention_mask"] for ex in batch])
+  labels = torch.stack([ex["labels"] for ex in batch])
+  input_len = max(int(attention_mask.sum(dim=1).max()), 1)
+  label_len = max(int((labels != -100).sum(dim=1).max()), 1)
+  return {
+          "input_ids": input_ids[:, :input_len].long(),
+          "attention_mask": attention_mask[:, :input_len].long(),
+          "labels": labels[:, :label_len].long()
+      }
+
 def get_dataloader(filepath, label_file_path, batch_size=16):
     tokenizer = MT5Tokenizer.from_pretrained("google/mt5-small")
     dataset = ParsedDataset(filepath, label_file_path, tokenizer)
-    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True)
+    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True, collate_fn=collate_trim_padding)
     return dataloader
 
 
@@ -0,0 +1,161 @@
+import argparse
+import functools
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import time
+
+import torch                                # type: ignore
+
+from generation import SORT_WINDOW, DedupGenerator, load_checkpoint, save_checkpoint, token_lengths
+from model import generate_codeswitched_text_batch, load_generation_model, sample_xnli, write_xnli_groundtruth
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from util.generation_cache import GenerationCache
+
+# Step 3 over K forked worker processes. The parent samples XNLI once (the
+# seed is kept in plan.json so a resumed job sees the same sample), writes the
+# aligned ground-truth file and loads the model; its weights are moved to
+# shared memory and the workers inherit them through fork instead of loading
+# their own copy. Each worker gets a contiguous range of the sampled pairs and
+# its own torch thread budget, generates with the same deduplicating batch
+# path as the single-process run, and checkpoints its shard file after every
+# window of batches. Shard files are concatenated in order into the final output.
+#
+#   python codeswitch_model/shard_generate.py --workers 8 --threads 8
+#   python codeswitch_model/shard_generate.py --workers 16 --threads 4 --cpu_int8 --num_beams 1 --max_length_ratio 1.5
+
+_WORKER = {}
+
+
+def shard_ranges(n, shards):
+    bounds = [n * k // shards for k in range(shards + 1)]
+    return [(bgn, end) for bgn, end in zip(bounds[:-1], bounds[1:]) if end > bgn]
+
+
+def plan_shards(work_dir, shards, fraction, seed):
+    # fixed on the first run so a resumed job regenerates the same sample and ranges
+    plan_path = os.path.join(work_dir, "plan.json")
+    plan = load_checkpoint(plan_path)
+    if plan is not None and plan["fraction"] == fraction and (seed is None or plan["seed"] == seed):
+        return plan
+    if os.path.isdir(work_dir):
+        shutil.rmtree(work_dir)
+    os.makedirs(work_dir)
+    plan = {"fraction": fraction, "seed": random.randrange(2**32) if seed is None else seed, "shards": shards}
+    save_checkpoint(plan_path, plan)
+    return plan
+
+
+def _init_worker(model, tokenizer, dataset, options, threads):
+    torch.set_num_threads(threads)
+    # inherited through fork, only shard ranges cross the process boundary
+    _WORKER.update(model=model, tokenizer=tokenizer, dataset=dataset, options=options)
+
+
+def _generate_shard(shard):
+    opts = _WORKER["options"]
+    dataset = _WORKER["dataset"]
+    shard_id, bgn, end = shard
+    out_path = os.path.join(opts["work_dir"], "%05d.txt" % shard_id)
+    ckpt_path = out_path + ".ckpt"
+    state = load_checkpoint(ckpt_path) or {"pairs": 0, "out_size": 0, "done": False}
+    if state["done"]:
+        return shard_id, 0, 0.0
+
+    # sqlite connections cannot cross a fork; every worker opens its own, and they share the
+    # file's write lock (lookups are reads, writes wait and retry, see util/generation_cache.py)
+    cache = GenerationCache(opts["model_hash"]) if opts["model_hash"] else None
+    generate = DedupGenerator(functools.partial(generate_codeswitched_text_batch, _WORKER["model"], _WORKER["tokenizer"],
+                                                cache=cache, **opts["generation_options"]),
+                              batch_size=opts["batch_size"], length_fn=functools.partial(token_lengths, _WORKER["tokenizer"]))
+    window = opts["batch_size"] * SORT_WINDOW
+    count = 0
+    with open(out_path, "a", encoding="utf-8") as out:
+        # drop anything written after the last checkpoint
+        out.truncate(state["out_size"])
+        out.seek(state["out_size"])
+        for i in range(bgn + state["pairs"], end, window):
+            rows = dataset[i : min(i + window, end)]
+            batch_texts = [text for pair in zip(rows["premise"], rows["hypothesis"]) for text in pair]
+            for codeswitched in generate(batch_texts):
+                out.write(codeswitched + '\n')
+            out.flush()
+            os.fsync(out.fileno())
+            count += len(rows["premise"])
+            state = {"pairs": state["pairs"] + len(rows["premise"]), "out_size": out.tell(), "done": False}
+            save_checkpoint(ckpt_path, state)
+    state["done"] = True
+    save_checkpoint(ckpt_path, state)
+    if cache is not None:
+        cache.close()
+    return shard_id, count, generate.hit_rate()
+
+
+def generate_sharded(output_filename, model, tokenizer, model_hash=None, workers=1, threads=None, shards=None,
+                     fraction=0.2, seed=None, batch_size=64, **generation_options):
+    work_dir = output_filename + ".shards"
+    plan = plan_shards(work_dir, shards or workers, fraction, seed)
+    dataset = sample_xnli(plan["fraction"], plan["seed"])
+    write_xnli_groundtruth(dataset)
+    print(f"Sampled {len(dataset)} XNLI pairs (seed {plan['seed']})")
+
+    options = {
+        "work_dir": work_dir,
+        "model_hash": model_hash,
+        "batch_size": batch_size,
+        "generation_options": generation_options,
+    }
+    jobs = [(k, bgn, end) for k, (bgn, end) in enumerate(shard_ranges(len(dataset), plan["shards"]))]
+    threads = threads or max(1, (os.cpu_count() or 1) // workers)
+
+    start = time.time()
+    total = 0
+    if workers <= 1:
+        _init_worker(model, tokenizer, dataset, options, threads)
+        for job in jobs:
+            total += _generate_shard(job)[1]
+    else:
+        model.share_memory()
+        context = multiprocessing.get_context("fork")
+        with context.Pool(workers, initializer=_init_worker,
+                          initargs=(model, tokenizer, dataset, options, threads)) as pool:
+            for shard_id, count, hit_rate in pool.imap_unordered(_generate_shard, jobs):
+                total += count
+                print(f"Shard {shard_id} done ({count} pairs, dedup hit rate {hit_rate:.1%})")
+    elapsed = time.time() - start
+    print(f"Generated {total} pairs in {elapsed:.1f}s ({2 * total / max(elapsed, 1e-9):.1f} sentences/s)")
+
+    # ordered merge, then the shard files are no longer needed
+    tmp_output = output_filename + ".tmp"
+    with open(tmp_output, "wb") as fout:
+        for shard_id, _, _ in jobs:
+            with open(os.path.join(work_dir, "%05d.txt" % shard_id), "rb") as fin:
+                shutil.copyfileobj(fin, fout)
+    os.replace(tmp_output, output_filename)
+    shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output_file", type=str, default="outputs/codeswitched_eval.txt")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--threads", type=int, default=None, help="torch threads per worker (default: cores / workers)")
+    parser.add_argument("--shards", type=int, default=None, help="number of index ranges (default: workers)")
+    parser.add_argument("--fraction", type=float, default=0.2, help="fraction of XNLI train to codeswitch")
+    parser.add_argument("--seed", type=int, default=None, help="sample seed (default: random, kept for resuming)")
+    parser.add_argument("--batch_size", type=int, default=64, help="sentences per generate call")
+    parser.add_argument("--num_beams", type=int, default=1)
+    parser.add_argument("--max_length_ratio", type=float, default=None)
+    parser.add_argument("--cpu_int8", action="store_true")
+    parser.add_argument("--no_generation_cache", action="store_true")
+    args = parser.parse_args()
+
+    model, tokenizer, model_hash = load_generation_model(not args.no_generation_cache, args.cpu_int8, args.threads)
+    if next(model.parameters()).device.type == "cuda":
+        args.workers = 1
+    generate_sharded(args.output_file, model, tokenizer, model_hash, args.workers, args.threads, args.shards,
+                     args.fraction, args.seed, args.batch_size, num_beams=args.num_beams,
+                     max_length_ratio=args.max_length_ratio)
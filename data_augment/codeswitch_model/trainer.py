@@ -2,16 +2,27 @@
 trainer.py file adapted from A4
 """
 
+import contextlib
+import functools
 import math
 import logging
+import os
+import sys
+import time
 
 from tqdm import tqdm # type: ignore
-import numpy as np # type: ignore
 
 import torch           # type: ignore
 import torch.optim as optim      # type: ignore
 from torch.optim.lr_scheduler import LambdaLR   # type: ignore
+from torch.nn.parallel import DistributedDataParallel  # type: ignore
 from torch.utils.data.dataloader import DataLoader  # type: ignore
+from torch.utils.data.distributed import DistributedSampler  # type: ignore
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from util.train_log import AsyncScalarWriter
+from util.batching import LengthBucketSampler, seed_worker
+from util.distributed import all_reduce_host, get_rank, get_world_size, is_distributed, is_main_process, unwrap_model
 
 logger = logging.getLogger(__name__)
 
@@ -25,12 +36,33 @@ class TrainerConfig:
     weight_decay = 0.1 # only applied on matmul weights
     # learning rate decay params: linear warmup followed by cosine decay to 10% of original
     lr_decay = False
+    # both count real (non-pad) tokens, not padded positions
     warmup_tokens = 375e6 # these two numbers come from the GPT-3 paper, but may not be good defaults elsewhere
     final_tokens = 260e9 # (at what point we reach 10% of original LR)
     # checkpoint settings
     ckpt_path = None
     num_workers = 0 # for DataLoader
+    collate_fn = None # e.g. dynamic padding for pre-tokenized datasets
     writer = None
+    # sync-free loop: loss is accumulated on device and metrics are flushed every log_every steps
+    # from a background thread; LR decay then counts real (attention_mask) tokens on the host
+    sync_free = False
+    log_every = 50
+    max_batches = None # cap on batches per epoch, e.g. for throughput measurements
+    # memory/precision: "bf16" runs forward passes under bfloat16 autocast, gradients are
+    # accumulated over grad_accum_steps batches per optimizer step (effective batch =
+    # batch_size * grad_accum_steps * devices), gradient_checkpointing recomputes activations
+    precision = "fp32"
+    grad_accum_steps = 1
+    gradient_checkpointing = False
+    # DataLoaders are built once per train() call; with num_workers > 0 the workers persist across
+    # epochs, prefetch, and are seeded / capped at worker_threads torch threads by seed_worker
+    pin_memory = None # default: on when training on CUDA
+    persistent_workers = True
+    prefetch_factor = 2
+    worker_threads = 1
+    length_bucketing = False # train batches of similar length (the dataset must provide lengths())
+    seed = 0
     
     def __init__(self, **kwargs):
         for k,v in kwargs.items():
@@ -47,20 +79,51 @@ class Trainer:
         self.stop_early = stop_early
         self.prev_dev_loss = 100.0
 
-        # take over whatever gpus are on the system
+        self.is_main = is_main_process()
+
+        if config.gradient_checkpointing:
+            self.model.gradient_checkpointing_enable()
+
+        # under torchrun: one DistributedDataParallel replica per process (gloo on CPU);
+        # otherwise take over whatever gpus are on the system
         self.device = 'cpu'
-        if torch.cuda.is_available():
+        if is_distributed():
+            if torch.cuda.is_available():
+                self.device = torch.cuda.current_device()
+            self.model = DistributedDataParallel(self.model.to(self.device),
+                                                 device_ids=[self.device] if torch.cuda.is_available() else None)
+        elif torch.cuda.is_available():
             self.device = torch.cuda.current_device()
             self.model = torch.nn.DataParallel(self.model).to(self.device)
         elif torch.backends.mps.is_available():
             self.device = 'mps'
             self.model = self.model.to(self.device)
+        self.autocast_device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+    def make_loader(self, data, is_train):
+        config = self.config
+        kwargs = dict(num_workers=config.num_workers, collate_fn=config.collate_fn,
+                      pin_memory=torch.cuda.is_available() if config.pin_memory is None else config.pin_memory,
+                      worker_init_fn=functools.partial(seed_worker, threads=config.worker_threads))
+        if config.num_workers > 0:
+            kwargs.update(persistent_workers=config.persistent_workers, prefetch_factor=config.prefetch_factor)
+        if is_train and config.length_bucketing:
+            sampler = LengthBucketSampler(data.lengths(), config.batch_size, seed=config.seed,
+                                          num_replicas=get_world_size(), rank=get_rank())
+            return DataLoader(data, batch_sampler=sampler, **kwargs)
+        if is_distributed():
+            # every rank reads its own 1/world_size of the data
+            sampler = DistributedSampler(data, shuffle=is_train, seed=config.seed)
+            return DataLoader(data, batch_size=config.batch_size, sampler=sampler, **kwargs)
+        generator = torch.Generator()
+        generator.manual_seed(config.seed)
+        return DataLoader(data, batch_size=config.batch_size, shuffle=is_train, generator=generator, **kwargs)
 
     def save_checkpoint(self):
-        if self.config.ckpt_path is not None:
-            ckpt_model = self.model.module if hasattr(self.model, "module") else self.model
+        # rank 0 writes the unwrapped state dict, loadable without DataParallel / DDP
+        if self.config.ckpt_path is not None and self.is_main:
             logger.info("saving %s", self.config.ckpt_path)
-            torch.save(ckpt_model.state_dict(), self.config.ckpt_path)
+            torch.save(unwrap_model(self.model).state_dict(), self.config.ckpt_path)
 
     def train(self):
         model, config = self.model, self.config
@@ -76,40 +139,88 @@ class Trainer:
         optimizer = optim.AdamW(optim_groups, lr=config.learning_rate, betas=config.betas)
         step = 0
         self.tokens = 0  # counter for LR decay
+        accum_steps = max(1, config.grad_accum_steps)
+        if is_distributed():
+            n_devices = get_world_size()
+        else:
+            n_devices = torch.cuda.device_count() if hasattr(model, "module") else 1
+        logger.info("effective batch size %d (batch %d x accumulation %d x devices %d), precision %s",
+                    config.batch_size * accum_steps * n_devices, config.batch_size, accum_steps, n_devices, config.precision)
+        if self.is_main:
+            print("Effective batch size: %d" % (config.batch_size * accum_steps * n_devices))
+
+        # built once: persistent workers are reused by every epoch
+        loaders = {'train': self.make_loader(self.train_dataset, True)}
+        if self.dev_dataset is not None:
+            loaders['dev'] = self.make_loader(self.dev_dataset, False)
 
         def run_epoch(split):
             nonlocal step
             is_train = (split == 'train')
             model.train(is_train)
-            data = self.train_dataset if is_train else self.dev_dataset
-            loader = DataLoader(data, batch_size=config.batch_size, shuffle=is_train, num_workers=config.num_workers)
+            loader = loaders[split]
+            for sampler in (loader.sampler, loader.batch_sampler):
+                if hasattr(sampler, "set_epoch"):
+                    sampler.set_epoch(epoch)
             losses = []
-            pbar = tqdm(enumerate(loader), total=len(loader)) if is_train else enumerate(loader)
+            loss_sum = torch.zeros((), device=self.device)  # on-device accumulator (sync_free)
+            window = 0
+            epoch_tokens = 0
+            start = time.time()
+            first_batch = None  # loader startup latency
+            n_batches = len(loader) if config.max_batches is None else min(len(loader), config.max_batches)
+            if is_train:
+                model.zero_grad()
+            pbar = tqdm(enumerate(loader), total=len(loader), disable=not self.is_main) if is_train else enumerate(loader)
             for it, batch in pbar:
+                if config.max_batches is not None and it >= config.max_batches:
+                    break
+                if first_batch is None:
+                    first_batch = time.time() - start
+                # real tokens, counted on the host batch so it never waits on the device
+                n_tokens = int(batch['attention_mask'].sum())
+                epoch_tokens += n_tokens
+
                 # Move all batch tensors to the appropriate device.
-                input_ids = batch['input_ids'].to(self.device)
-                attention_mask = batch['attention_mask'].to(self.device)
-                labels = batch['labels'].to(self.device)
+                input_ids = batch['input_ids'].to(self.device, non_blocking=True)
+                attention_mask = batch['attention_mask'].to(self.device, non_blocking=True)
+                labels = batch['labels'].to(self.device, non_blocking=True)
 
-                with torch.set_grad_enabled(is_train):
-                    output = model(
-                        input_ids=input_ids, attention_mask=attention_mask, labels=labels
-                    )
-                    loss = output.loss
-                    logits = output.logits
+                update = is_train and ((it + 1) % accum_steps == 0 or it + 1 == n_batches)
+                # DDP all-reduces gradients only on the micro-batch that steps the optimizer
+                no_sync = model.no_sync() if is_train and not update and isinstance(model, DistributedDataParallel) \
+                    else contextlib.nullcontext()
+                with no_sync:
+                    with torch.set_grad_enabled(is_train), torch.autocast(self.autocast_device, dtype=torch.bfloat16,
+                                                                          enabled=config.precision == "bf16"):
+                        output = model(
+                            input_ids=input_ids, attention_mask=attention_mask, labels=labels
+                        )
+                        loss = output.loss
+                        logits = output.logits
 
-                    loss = loss.mean()  # if model is wrapped in DataParallel
-                    losses.append(loss.item())
+                        loss = loss.mean()  # if model is wrapped in DataParallel
+                        if config.sync_free:
+                            loss_sum = loss_sum + loss.detach()
+                            window += 1
+                        else:
+                            losses.append(loss.item())
+                    if is_train:
+                        (loss / accum_steps).backward()
 
                 if is_train:
-                    model.zero_grad()
-                    loss.backward()
-                    torch.nn.utils.clip_grad_norm_(model.parameters(), config.grad_norm_clip)
-                    optimizer.step()
+                    if update:
+                        torch.nn.utils.clip_grad_norm_(model.parameters(), config.grad_norm_clip)
+                        optimizer.step()
+                        model.zero_grad()
 
                     if config.lr_decay:
                         # Update token counter and adjust learning rate.
-                        self.tokens += (attention_mask >= 0).sum().item()  # counting tokens processed
+                        batch_tokens = n_tokens  # real (non-pad) tokens, whatever the padding mode
+                        if is_distributed():
+                            # global count, so every replica follows the same schedule
+                            batch_tokens = int(all_reduce_host([batch_tokens])[0])
+                        self.tokens += batch_tokens
                         if self.tokens < config.warmup_tokens:
                             lr_mult = float(self.tokens) / float(max(1, config.warmup_tokens))
                         else:
@@ -121,20 +232,40 @@ class Trainer:
                     else:
                         lr = config.learning_rate
 
-                    pbar.set_description(f"epoch {epoch+1} iter {it}: train loss {loss.item():.5f}, lr {lr:e}")
+                    if config.sync_free:
+                        if window == config.log_every:
+                            metrics.add_scalars(step, {'train/loss': loss_sum / window, 'train/lr': lr})
+                            loss_sum = torch.zeros((), device=self.device)
+                            window = 0
+                            if 'train/loss' in metrics.last:
+                                pbar.set_description(f"epoch {epoch+1} iter {it}: train loss {metrics.last['train/loss']:.5f}, lr {lr:e}")
+                    else:
+                        pbar.set_description(f"epoch {epoch+1} iter {it}: train loss {loss.item():.5f}, lr {lr:e}")
 
-                    if config.writer is not None:
-                        config.writer.add_scalar('train/loss', loss.item(), step)
-                        config.writer.add_scalar('train/lr', lr, step)
+                        if config.writer is not None:
+                            config.writer.add_scalar('train/loss', loss.item(), step)
+                            config.writer.add_scalar('train/lr', lr, step)
                     step += 1
 
+            if is_train and config.sync_free and window > 0:
+                metrics.add_scalars(step, {'train/loss': loss_sum / window, 'train/lr': lr})
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            elapsed = time.time() - start
+            logger.info("%s epoch %d: %d tokens in %.1fs (%.0f tokens/s), first batch after %.2fs", split, epoch + 1,
+                        epoch_tokens, elapsed, epoch_tokens / max(elapsed, 1e-9), first_batch or 0.0)
             if not is_train:
-                logger.info("Dev loss: %f", np.mean(losses))
-                print("Dev loss: %f" % np.mean(losses))
-                return np.mean(losses)
+                # averaged over every rank's shard of the dev set
+                total, count = all_reduce_host([loss_sum.item(), window] if config.sync_free else [sum(losses), len(losses)])
+                dev_loss = total / max(count, 1)
+                logger.info("Dev loss: %f", dev_loss)
+                if self.is_main:
+                    print("Dev loss: %f" % dev_loss)
+                return dev_loss
             else:
                 return loss.item()
 
+        metrics = AsyncScalarWriter(config.writer) if config.sync_free else None
         for epoch in range(config.max_epochs):
             loss = run_epoch('train')
             
@@ -144,21 +275,25 @@ class Trainer:
                     break
                 self.prev_dev_loss = loss
             self.save_checkpoint()
+        if metrics is not None:
+            metrics.close()
 
     def evaluate(self):
         model = self.model
         model.eval()
-        dev_loader = DataLoader(self.dev_dataset, batch_size=self.config.batch_size, shuffle=False, num_workers=self.config.num_workers)
+        dev_loader = self.make_loader(self.dev_dataset, False)
         total_loss = 0.0
         with torch.no_grad():
             for batch in tqdm(dev_loader, desc="Evaluating"):
-                input_ids = batch['input_ids'].to(self.device)
-                attention_mask = batch['attention_mask'].to(self.device)
-                labels = batch['labels'].to(self.device)
+                input_ids = batch['input_ids'].to(self.device, non_blocking=True)
+                attention_mask = batch['attention_mask'].to(self.device, non_blocking=True)
+                labels = batch['labels'].to(self.device, non_blocking=True)
                 _, _, loss = model(input_ids=input_ids, attention_mask=attention_mask,
                                    labels=labels,)
                 total_loss += loss.item()
-        avg_loss = total_loss / len(dev_loader)
+        total_loss, n_batches = all_reduce_host([total_loss, len(dev_loader)])
+        avg_loss = total_loss / n_batches
         logger.info(f"Dev Loss: {avg_loss:.4f}")
-        print(f"Dev Loss: {avg_loss:.4f}")
+        if self.is_main:
+            print(f"Dev Loss: {avg_loss:.4f}")
         model.train() 
\ No newline at end of file
@@ -4,65 +4,38 @@ import torch
 from transformers import BertTokenizerFast
 from dataset import UDParsingDataset
 from model import BertForParsing
+from annotation import AnnotationEngine, open_output
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 HINGLISH_FILE = os.path.join(BASE_DIR, "../dataset/enghinglish/test.txt")
 
 
+def read_sentences(fin):
+    for line in fin:
+        parts = line.strip().split("\t")
+        english_sentence = parts[0].strip()
+        if english_sentence:
+            yield english_sentence, english_sentence.split()
+
 def annotate_file(input_file, output_file, model, tokenizer, config, pos_label2id, dep_label2id):
-    model.eval()
-    id2pos_label = {v: k for k, v in pos_label2id.items()}
-    id2dep_label = {v: k for k, v in dep_label2id.items()}
-    
-    with open(input_file, "r", encoding="utf-8") as fin, open(output_file, "w", encoding="utf-8") as fout:
-        for line in fin:
-            parts = line.strip().split("\t")
-            if len(parts) < 1:
-                continue
-            
-            english_sentence = parts[0].strip()
-            if not english_sentence:
-                continue
-            
-            words = english_sentence.split()
-            encoding = tokenizer(words, is_split_into_words=True, truncation=True, padding="max_length", 
-                                 max_length=config.max_length, return_offsets_mapping=True)
-            word_ids = encoding.word_ids()
-            
-            input_ids = torch.tensor([encoding["input_ids"]]).to(model.device)
-            attention_mask = torch.tensor([encoding["attention_mask"]]).to(model.device)
-            
-            with torch.no_grad():
-                pos_logits, dep_logits, head_logits, _ = model(input_ids, attention_mask, 
-                                                               pos_labels=None, dep_labels=None, head_labels=None)
-            
-            pos_preds = pos_logits.argmax(dim=-1).squeeze(0).tolist()
-            dep_preds = dep_logits.argmax(dim=-1).squeeze(0).tolist()
-            
-            pred_pos = {}
-            pred_dep = {}
-            for idx, word_idx in enumerate(word_ids):
-                if word_idx is None:
-                    continue
-                if word_idx not in pred_pos:
-                    pred_pos[word_idx] = pos_preds[idx]
-                    pred_dep[word_idx] = dep_preds[idx]
-            
-            pos_tags = [id2pos_label[p] if p in id2pos_label else "UNK" for p in pred_pos]
-            dep_tags = [id2dep_label[d] if d in id2dep_label else "UNK" for d in pred_dep]
-            fout.write(english_sentence + "\t" + " ".join(pos_tags) + "\t" + " ".join(dep_tags) + "\n")
+    engine = AnnotationEngine(model, tokenizer, pos_label2id, dep_label2id, max_length=config.max_length,
+                              batch_size=config.batch_size)
+    with open(input_file, "r", encoding="utf-8") as fin, open_output(output_file, pos_label2id, dep_label2id) as fout:
+        engine.annotate(read_sentences(fin), fout)
 
 
-def annotate_hinglish_file(model, tokenizer, config, pos_label2id, dep_label2id):
+def annotate_hinglish_file(model, tokenizer, config, pos_label2id, dep_label2id, ext=".txt"):
     output_dir = os.path.join(BASE_DIR, "annotated")
     os.makedirs(output_dir, exist_ok=True)
-    annotate_file(HINGLISH_FILE, os.path.join(output_dir, "annotated_hinglish_en_test.txt"), model, tokenizer, config, pos_label2id, dep_label2id)
+    annotate_file(HINGLISH_FILE, os.path.join(output_dir, "annotated_hinglish_en_test" + ext), model, tokenizer, config, pos_label2id, dep_label2id)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--model_path", type=str, required=True, help="Path to the fine-tuned model state dict")
     parser.add_argument("--max_length", type=int, default=128)
+    parser.add_argument("--batch_size", type=int, default=64, help="sentences per forward pass")
+    parser.add_argument("--store", action="store_true", help="write a binary annotation store (.anno) instead of TSV")
     args = parser.parse_args()
 
     tokenizer = BertTokenizerFast.from_pretrained("bert-base-multilingual-cased")
@@ -82,5 +55,6 @@ if __name__ == "__main__":
         pass
     config = Config()
     config.max_length = args.max_length
+    config.batch_size = args.batch_size
 
-    annotate_hinglish_file(model, tokenizer, config, pos_label2id, dep_label2id)
+    annotate_hinglish_file(model, tokenizer, config, pos_label2id, dep_label2id, ".anno" if args.store else ".txt")
@@ -0,0 +1,112 @@
+import os
+import sys
+
+import numpy as np
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from util.annotation_store import SUFFIX as STORE_SUFFIX, AnnotationWriter
+
+# Batched inference shared by annotate.py, annotate_hinglish.py and
+# evaluate.annotate_xnli. Sentences are read in chunks, sorted by subword
+# length, padded per batch and run through BertForParsing under no_grad.
+# Predictions are mapped back to words with a vectorized first-subword gather,
+# and lines are written in the original input order, either as TSV or, for an
+# output path ending in .anno, to the binary store in util/annotation_store.py.
+
+def split_words(sentence, lang):
+    # english/spanish: whitespace, chinese: split by characters
+    if lang == "zh":
+        return list(sentence)
+    return sentence.split()
+
+
+def open_output(output_file, pos_label2id, dep_label2id):
+    if output_file.endswith(STORE_SUFFIX):
+        # store ids follow the model's label ids
+        return AnnotationWriter(output_file,
+                                [k for k, _ in sorted(pos_label2id.items(), key=lambda kv: kv[1])],
+                                [k for k, _ in sorted(dep_label2id.items(), key=lambda kv: kv[1])])
+    return open(output_file, "w", encoding="utf-8")
+
+
+class AnnotationEngine(object):
+    def __init__(self, model, tokenizer, pos_label2id, dep_label2id, max_length=128, batch_size=64, chunk_size=4096):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.id2pos_label = {v: k for k, v in pos_label2id.items()}
+        self.id2dep_label = {v: k for k, v in dep_label2id.items()}
+
+    def predict(self, word_lists):
+        """Return (pos_ids, dep_ids) per sentence, one id per word, -1 for words with no subword (e.g. truncated)."""
+        encoding = self.tokenizer(word_lists, is_split_into_words=True, truncation=True, max_length=self.max_length)
+        lengths = np.array([len(ids) for ids in encoding["input_ids"]])
+        n_words = np.array([len(words) for words in word_lists])
+        word_offsets = np.concatenate([[0], np.cumsum(n_words)])
+        pos_out = np.full(word_offsets[-1], -1, dtype=np.int64)
+        dep_out = np.full(word_offsets[-1], -1, dtype=np.int64)
+        pad_id = self.tokenizer.pad_token_id or 0
+
+        self.model.eval()
+        order = np.argsort(lengths, kind="stable")
+        for bgn in range(0, len(order), self.batch_size):
+            rows = order[bgn : bgn + self.batch_size]
+            width = lengths[rows].max()
+            input_ids = np.full((len(rows), width), pad_id, dtype=np.int64)
+            word_ids = np.full((len(rows), width), -1, dtype=np.int64)
+            for i, row in enumerate(rows):
+                input_ids[i, : lengths[row]] = encoding["input_ids"][row]
+                word_ids[i, : lengths[row]] = [-1 if w is None else w for w in encoding.word_ids(row)]
+            attention_mask = (np.arange(width)[None, :] < lengths[rows][:, None]).astype(np.int64)
+
+            with torch.no_grad():
+                pos_logits, dep_logits, _, _ = self.model(torch.from_numpy(input_ids).to(self.model.device),
+                                                          torch.from_numpy(attention_mask).to(self.model.device),
+                                                          pos_labels=None, dep_labels=None, head_labels=None)
+            pos_preds = pos_logits.argmax(dim=-1).cpu().numpy()
+            dep_preds = dep_logits.argmax(dim=-1).cpu().numpy()
+
+            # first subword of every word
+            previous = np.concatenate([np.full((len(rows), 1), -1), word_ids[:, :-1]], axis=1)
+            r, c = np.nonzero((word_ids >= 0) & (word_ids != previous))
+            target = word_offsets[rows[r]] + word_ids[r, c]
+            pos_out[target] = pos_preds[r, c]
+            dep_out[target] = dep_preds[r, c]
+
+        return [(pos_out[bgn:end], dep_out[bgn:end]) for bgn, end in zip(word_offsets[:-1], word_offsets[1:])]
+
+    def tags(self, pos_ids, dep_ids, keep_missing=False):
+        # keep_missing emits "UNK" for words without a prediction instead of dropping them
+        keep = slice(None) if keep_missing else pos_ids >= 0
+        pos_tags = [self.id2pos_label.get(p, "UNK") for p in pos_ids[keep].tolist()]
+        dep_tags = [self.id2dep_label.get(d, "UNK") for d in dep_ids[keep].tolist()]
+        return pos_tags, dep_tags
+
+    def annotate(self, items, fout, keep_missing=False):
+        """Write `text<TAB>POS tags<TAB>DEP tags` (or a store record) for every (text, words) item, in input order."""
+        chunk = []
+        count = 0
+        for item in items:
+            chunk.append(item)
+            if len(chunk) == self.chunk_size:
+                count += self.write_chunk(chunk, fout, keep_missing)
+                chunk = []
+        if chunk:
+            count += self.write_chunk(chunk, fout, keep_missing)
+        return count
+
+    def write_chunk(self, chunk, fout, keep_missing):
+        predictions = self.predict([words for _, words in chunk])
+        if isinstance(fout, AnnotationWriter):
+            for (text, _), (pos_ids, dep_ids) in zip(chunk, predictions):
+                fout.add(text, *self.tags(pos_ids, dep_ids, keep_missing))
+            return len(chunk)
+        lines = []
+        for (text, _), (pos_ids, dep_ids) in zip(chunk, predictions):
+            pos_tags, dep_tags = self.tags(pos_ids, dep_ids, keep_missing)
+            lines.append(text + "\t" + " ".join(pos_tags) + "\t" + " ".join(dep_tags) + "\n")
+        fout.writelines(lines)
+        return len(chunk)
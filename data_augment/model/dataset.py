@@ -1,124 +1,170 @@
+import hashlib
+import json
+import os
+
+import numpy as np
 import torch
 from torch.utils.data import Dataset
 from transformers import BertTokenizerFast
 
-class UDParsingDataset(Dataset):
-    def __init__(self, file_path, tokenizer: BertTokenizerFast, pos_label2id=None, dep_label2id=None, max_length=128):
-        self.tokenizer = tokenizer
-        self.max_length = max_length
-        self.sentences = []
-        self.pos_labels = []
-        self.dep_labels = []
-        self.heads = []
-        
-        pos_set = set()
-        dep_set = set()
-        
+# UD parsing data: CoNLL-U treebanks are parsed as a stream, tokenized in
+# large batches with the fast tokenizer, and the first-subword aligned labels
+# are kept in contiguous NumPy arrays. The arrays are cached on disk, keyed by
+# the content hash of the input files, the label maps and max_length.
+
+def read_conllu(file_paths):
+    """Yield (tokens, upos, deprel, head) lists for every sentence in the given CoNLL-U files."""
+    for file_path in file_paths:
         with open(file_path, encoding='utf-8') as f:
-            sentence_tokens = []
-            sentence_pos = []
-            sentence_dep = []
-            sentence_heads = []
+            tokens, pos, dep, heads = [], [], [], []
             for line in f:
                 line = line.strip()
                 if not line:
-                    # End of sentence; if tokens have been collected, append.
-                    if sentence_tokens:
-                        self.sentences.append(sentence_tokens)
-                        self.pos_labels.append(sentence_pos)
-                        self.dep_labels.append(sentence_dep)
-                        self.heads.append(sentence_heads)
-                        sentence_tokens = []
-                        sentence_pos = []
-                        sentence_dep = []
-                        sentence_heads = []
+                    # End of sentence; if tokens have been collected, yield.
+                    if tokens:
+                        yield tokens, pos, dep, heads
+                        tokens, pos, dep, heads = [], [], [], []
                     continue
                 if line.startswith("#"):
                     continue
                 parts = line.split("\t")
                 if len(parts) < 10:
                     continue
-                if len(parts) > 10:
-                    parts = parts[:10]
                 if "-" in parts[0] or "." in parts[0]:
                     continue
-                token = parts[1]      # FORM
-                pos = parts[3]        # UPOS
-                dep = parts[7]        # DEPREL
-                head = parts[6]       # HEAD
-                sentence_tokens.append(token)
-                sentence_pos.append(pos)
-                sentence_dep.append(dep)
-                sentence_heads.append(head)
-                pos_set.add(pos)
-                dep_set.add(dep)
-            if sentence_tokens:
-                self.sentences.append(sentence_tokens)
-                self.pos_labels.append(sentence_pos)
-                self.dep_labels.append(sentence_dep)
-                self.heads.append(sentence_heads)
-        
-        # Build label mappings if not provided
-        if pos_label2id is None:
-            self.pos_label2id = {label: idx for idx, label in enumerate(sorted(list(pos_set)))}
-        else:
-            self.pos_label2id = pos_label2id
-            
-        if dep_label2id is None:
-            self.dep_label2id = {label: idx for idx, label in enumerate(sorted(list(dep_set)))}
+                tokens.append(parts[1])      # FORM
+                pos.append(parts[3])         # UPOS
+                dep.append(parts[7])         # DEPREL
+                # HEAD; "_" (unannotated) becomes -100 and is ignored by the loss
+                heads.append(int(parts[6]) if parts[6] != "_" else -100)
+            if tokens:
+                yield tokens, pos, dep, heads
+
+
+def file_hash(file_paths):
+    digest = hashlib.sha1()
+    for file_path in file_paths:
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+class UDParsingDataset(Dataset):
+    def __init__(self, file_path, tokenizer: BertTokenizerFast, pos_label2id=None, dep_label2id=None, max_length=128,
+                 cache_dir=None, batch_size=1024):
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+        self.batch_size = batch_size
+        file_paths = [file_path] if isinstance(file_path, str) else list(file_path)
+
+        key = json.dumps([file_hash(file_paths), getattr(tokenizer, "name_or_path", ""), max_length,
+                          pos_label2id, dep_label2id], sort_keys=True)
+        cache_dir = cache_dir or os.path.join(os.path.dirname(os.path.abspath(file_paths[0])), "cache")
+        cache_file = os.path.join(cache_dir, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".npz")
+        if os.path.exists(cache_file):
+            arrays = np.load(cache_file)
+            pos_label2id = json.loads(str(arrays["pos_label2id"]))
+            dep_label2id = json.loads(str(arrays["dep_label2id"]))
         else:
-            self.dep_label2id = dep_label2id
-        
+            if pos_label2id is None or dep_label2id is None:
+                # Build label mappings if not provided (one extra streaming pass)
+                pos_set = set()
+                dep_set = set()
+                for _, pos, dep, _ in read_conllu(file_paths):
+                    pos_set.update(pos)
+                    dep_set.update(dep)
+                if pos_label2id is None:
+                    pos_label2id = {label: idx for idx, label in enumerate(sorted(pos_set))}
+                if dep_label2id is None:
+                    dep_label2id = {label: idx for idx, label in enumerate(sorted(dep_set))}
+            arrays = self.encode(file_paths, pos_label2id, dep_label2id)
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_file = cache_file + ".tmp.npz"
+            np.savez(tmp_file, pos_label2id=json.dumps(pos_label2id), dep_label2id=json.dumps(dep_label2id), **arrays)
+            os.replace(tmp_file, cache_file)
+
+        self.pos_label2id = pos_label2id
+        self.dep_label2id = dep_label2id
         self.id2pos = {v: k for k, v in self.pos_label2id.items()}
         self.id2dep = {v: k for k, v in self.dep_label2id.items()}
-        
-        # Preprocess each sentence: tokenize and align labels
-        self.examples = []
-        for tokens, pos_tags, dep_tags, head_tags in zip(self.sentences, self.pos_labels, self.dep_labels, self.heads):
-            encoding = self.tokenizer(tokens,
-                                      is_split_into_words=True,
-                                      truncation=True,
-                                      padding='max_length',
-                                      max_length=self.max_length,
-                                      return_offsets_mapping=True)
-            word_ids = encoding.word_ids()
-            pos_label_ids = []
-            dep_label_ids = []
-            head_label_ids = []
-            previous_word_idx = None
-            for word_idx in word_ids:
-                if word_idx is None:
-                    pos_label_ids.append(-100)
-                    dep_label_ids.append(-100)
-                    head_label_ids.append(-100)
-                elif word_idx != previous_word_idx:
-                    pos_label_ids.append(self.pos_label2id[pos_tags[word_idx]])
-                    dep_label_ids.append(self.dep_label2id[dep_tags[word_idx]])
-                    # Convert head index from string to integer:
-                    # For non-root tokens, subtract 1 to convert from 1-indexed to 0-indexed.
-                    # For a root token (head == "0"), use the token's own word index.
-                    h = int(head_tags[word_idx])
-                    if h == 0:
-                        head_label_ids.append(word_idx)
-                    else:
-                        head_label_ids.append(h - 1)
-                else:
-                    pos_label_ids.append(-100)
-                    dep_label_ids.append(-100)
-                    head_label_ids.append(-100)
-                previous_word_idx = word_idx
-            encoding.pop("offset_mapping")
-            encoding["pos_labels"] = pos_label_ids
-            encoding["dep_labels"] = dep_label_ids
-            encoding["head_labels"] = head_label_ids
-            self.examples.append(encoding)
-    
+
+        self.input_ids = arrays["input_ids"]
+        self.attention_mask = arrays["attention_mask"]
+        self.pos_labels = arrays["pos_labels"]
+        self.dep_labels = arrays["dep_labels"]
+        self.head_labels = arrays["head_labels"]
+
+    def encode(self, file_paths, pos_label2id, dep_label2id):
+        chunks = {name: [] for name in ("input_ids", "attention_mask", "pos_labels", "dep_labels", "head_labels")}
+        batch = []
+        for sentence in read_conllu(file_paths):
+            batch.append(sentence)
+            if len(batch) == self.batch_size:
+                for name, value in self.encode_batch(batch, pos_label2id, dep_label2id).items():
+                    chunks[name].append(value)
+                batch = []
+        if batch:
+            for name, value in self.encode_batch(batch, pos_label2id, dep_label2id).items():
+                chunks[name].append(value)
+        if not chunks["input_ids"]:
+            empty = np.zeros((0, self.max_length), dtype=np.int32)
+            return {name: empty for name in chunks}
+        return {name: np.concatenate(values) for name, values in chunks.items()}
+
+    def encode_batch(self, batch, pos_label2id, dep_label2id):
+        encoding = self.tokenizer([tokens for tokens, _, _, _ in batch],
+                                  is_split_into_words=True,
+                                  truncation=True,
+                                  padding='max_length',
+                                  max_length=self.max_length,
+                                  return_tensors="np")
+        # word index of every subword, -1 for special and pad tokens
+        word_ids = np.array([[-1 if w is None else w for w in encoding.word_ids(i)] for i in range(len(batch))],
+                            dtype=np.int64)
+        previous = np.concatenate([np.full((len(batch), 1), -1), word_ids[:, :-1]], axis=1)
+        first = (word_ids >= 0) & (word_ids != previous)
+
+        # per-word labels of the whole batch, flattened; subwords gather from them
+        offsets = np.cumsum([0] + [len(tokens) for tokens, _, _, _ in batch])[:-1]
+        flat_pos = np.array([pos_label2id[p] for _, pos, _, _ in batch for p in pos], dtype=np.int64)
+        flat_dep = np.array([dep_label2id[d] for _, _, dep, _ in batch for d in dep], dtype=np.int64)
+        flat_head = np.array([h for _, _, _, heads in batch for h in heads], dtype=np.int64)
+        gather = np.where(first, offsets[:, None] + word_ids, 0)
+
+        # For non-root tokens, subtract 1 to convert from 1-indexed to 0-indexed.
+        # For a root token (head == 0), use the token's own word index.
+        head = flat_head[gather]
+        head = np.where(head == 0, word_ids, np.where(head > 0, head - 1, -100))
+        return {
+            "input_ids": encoding["input_ids"].astype(np.int32),
+            "attention_mask": encoding["attention_mask"].astype(np.int8),
+            "pos_labels": np.where(first, flat_pos[gather], -100).astype(np.int16),
+            "dep_labels": np.where(first, flat_dep[gather], -100).astype(np.int16),
+            "head_labels": np.where(first, head, -100).astype(np.int16),
+        }
+
     def __len__(self):
-        return len(self.examples)
-    
+        return len(self.input_ids)
+
+    def lengths(self):
+        # subword tokens per sentence, for length-bucketed batching
+        return self.attention_mask.sum(axis=1)
+
     def __getitem__(self, idx):
-        item = {key: torch.tensor(val) for key, val in self.examples[idx].items()}
-        return item
+        return {
+            "input_ids": torch.from_numpy(self.input_ids[idx]).long(),
+            "attention_mask": torch.from_numpy(self.attention_mask[idx]).long(),
+            "pos_labels": torch.from_numpy(self.pos_labels[idx]).long(),
+            "dep_labels": torch.from_numpy(self.dep_labels[idx]).long(),
+            "head_labels": torch.from_numpy(self.head_labels[idx]).long(),
+        }
+
+def collate_trim_padding(batch):
+    # stack and cut every column that is padding for the whole batch
+    batch = {k: torch.stack([ex[k] for ex in batch]) for k in batch[0]}
+    width = max(int(batch["attention_mask"].sum(dim=1).max()), 1)
+    return {k: v[:, :width].contiguous() for k, v in batch.items()}
 
 # sanity check
 if __name__ == "__main__":
@@ -1,125 +1,120 @@
 import argparse
 import csv
 import torch
+from torch.utils.data import DataLoader
 from transformers import BertTokenizerFast
 from dataset import UDParsingDataset
 from model import BertForParsing
+from annotation import AnnotationEngine, open_output, split_words
 
-# evaluating the fine-tuned model on a test CoNLL-U file
-def evaluate_finetuned(test_file, output_file, model, tokenizer, config, pos_label2id, dep_label2id):
+# evaluating a model on a test CoNLL-U file in one batched pass: predictions are streamed to
+# output_file (if given) while POS/DEP accuracy and head attachment accuracy (UAS) are
+# accumulated in on-device counters, optionally with per-label confusion counts
+def evaluate_parser(test_file, output_file, model, tokenizer, config, pos_label2id, dep_label2id, confusion=False):
     test_dataset = UDParsingDataset(test_file, tokenizer, 
                                     pos_label2id=pos_label2id, 
                                     dep_label2id=dep_label2id,
-                                    max_length=config.max_length)
+                                    max_length=config.max_length,
+                                    cache_dir=config.cache_dir)
     print("Number of examples in test dataset:", len(test_dataset))
 
     model.eval()
+    device = model.device
     id2pos = {v: k for k, v in pos_label2id.items()}
     id2dep = {v: k for k, v in dep_label2id.items()}
-
-    with torch.no_grad(), open(output_file, "w", encoding="utf-8") as fout:
-        for example in test_dataset:
-            input_ids = example["input_ids"].unsqueeze(0).to(model.device)
-            attention_mask = example["attention_mask"].unsqueeze(0).to(model.device)
-            pos_logits, dep_logits, head_logits, _ = model(input_ids, attention_mask,
+    num_pos, num_dep = len(pos_label2id), len(dep_label2id)
+    # correct_pos, correct_dep, correct_head, total tokens
+    counts = torch.zeros(4, dtype=torch.long, device=device)
+    pos_confusion = torch.zeros(num_pos * num_pos, dtype=torch.long, device=device) if confusion else None
+    dep_confusion = torch.zeros(num_dep * num_dep, dtype=torch.long, device=device) if confusion else None
+
+    loader = DataLoader(test_dataset, batch_size=config.batch_size, shuffle=False)
+    fout = open(output_file, "w", encoding="utf-8") if output_file else None
+    with torch.no_grad():
+        for batch in loader:
+            # trim the batch to its longest sentence
+            width = int(batch["attention_mask"].sum(dim=1).max())
+            batch = {k: v[:, :width].to(device) for k, v in batch.items()}
+            pos_logits, dep_logits, head_logits, _ = model(batch["input_ids"], batch["attention_mask"],
                                                            pos_labels=None, dep_labels=None, head_labels=None)
-            pos_preds = pos_logits.argmax(dim=-1).squeeze(0).tolist()
-            dep_preds = dep_logits.argmax(dim=-1).squeeze(0).tolist()
+            pos_preds = pos_logits.argmax(dim=-1)
+            dep_preds = dep_logits.argmax(dim=-1)
+            head_preds = head_logits.argmax(dim=-1)
+
+            mask = batch["pos_labels"] != -100
+            counts += torch.stack([
+                (pos_preds == batch["pos_labels"])[mask].sum(),
+                (dep_preds == batch["dep_labels"])[mask].sum(),
+                (head_preds == batch["head_labels"])[mask].sum(),
+                mask.sum(),
+            ])
+            if confusion:
+                pos_confusion += torch.bincount(batch["pos_labels"][mask] * num_pos + pos_preds[mask], minlength=num_pos * num_pos)
+                dep_confusion += torch.bincount(batch["dep_labels"][mask] * num_dep + dep_preds[mask], minlength=num_dep * num_dep)
+
+            if fout is not None:
+                texts = tokenizer.batch_decode(batch["input_ids"].tolist(), skip_special_tokens=True)
+                pos_rows = pos_preds.tolist()
+                dep_rows = dep_preds.tolist()
+                lines = []
+                for text, row_mask, pos_row, dep_row in zip(texts, mask.tolist(), pos_rows, dep_rows):
+                    pos_tags = [id2pos[p] for p, keep in zip(pos_row, row_mask) if keep]
+                    dep_tags = [id2dep[d] for d, keep in zip(dep_row, row_mask) if keep]
+                    lines.append(text + "\t" + " ".join(pos_tags) + "\t" + " ".join(dep_tags) + "\n")
+                fout.writelines(lines)
+    if fout is not None:
+        fout.close()
+
+    correct_pos, correct_dep, correct_head, total = counts.tolist()
+    results = {
+        "pos_accuracy": correct_pos / total if total > 0 else 0,
+        "dep_accuracy": correct_dep / total if total > 0 else 0,
+        "uas": correct_head / total if total > 0 else 0,
+    }
+    if confusion:
+        results["pos_confusion"] = pos_confusion.view(num_pos, num_pos).cpu().numpy()
+        results["dep_confusion"] = dep_confusion.view(num_dep, num_dep).cpu().numpy()
+    return results
+
+def write_confusion(path, matrix, id2label):
+    # rows are gold labels, columns predicted labels
+    labels = [id2label[i] for i in range(len(id2label))]
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("gold\\pred\t" + "\t".join(labels) + "\n")
+        for label, row in zip(labels, matrix.tolist()):
+            f.write(label + "\t" + "\t".join(str(c) for c in row) + "\n")
 
-            valid_indices = [i for i, lbl in enumerate(example["pos_labels"].tolist()) if lbl != -100]
-            pos_tags = [id2pos[pos_preds[i]] for i in valid_indices]
-            dep_tags = [id2dep[dep_preds[i]] for i in valid_indices]
-
-            text = tokenizer.decode(example["input_ids"].tolist(), skip_special_tokens=True)
-            fout.write(text + "\t" + " ".join(pos_tags) + "\t" + " ".join(dep_tags) + "\n")
+def evaluate_finetuned(test_file, output_file, model, tokenizer, config, pos_label2id, dep_label2id):
+    return evaluate_parser(test_file, output_file, model, tokenizer, config, pos_label2id, dep_label2id)
 
 # annotate new data from XNLI file with finetuned mBERT -> output will be input for seq2seq model
+def read_xnli_sentences(fin, fieldnames=None):
+    # fieldnames is given when fin is a headerless slice of the file (see shard_annotate.py)
+    reader = csv.DictReader(fin, fieldnames=fieldnames, delimiter="\t")
+    for row in reader:
+        lang = row.get("language", "").lower()
+        # only process english, chinese, and spanish
+        if lang not in {"en", "zh", "es"}:
+            continue
+        sentence = row.get("sentence1", "")
+        if not sentence.strip():
+            continue
+        yield sentence, split_words(sentence, lang)
+
 def annotate_xnli(tsv_file, output_file, model, tokenizer, config, pos_label2id, dep_label2id):
-    model.eval()
-    id2pos_label = {v: k for k, v in pos_label2id.items()}
-    id2dep_label = {v: k for k, v in dep_label2id.items()}
-    with open(tsv_file, "r", encoding="utf-8") as fin, open(output_file, "w", encoding="utf-8") as fout:
-        reader = csv.DictReader(fin, delimiter="\t")
-        for row in reader:
-            lang = row.get("language", "").lower()
-            # only process english, chinese, and spanish
-            if lang not in {"en", "zh", "es"}:
-                continue
-            sentence = row.get("sentence1", "")
-            if not sentence.strip():
-                continue
-
-            # tokenizing the sentence into words - english/spanish: whitespace, chinese: split by characters
-            if lang in {"en", "es"}:
-                words = sentence.split()
-            elif lang == "zh":
-                words = list(sentence)
-            else:
-                words = sentence.split()
-            
-            encoding = tokenizer(words,
-                                 is_split_into_words=True,
-                                 truncation=True,
-                                 padding="max_length",
-                                 max_length=config.max_length,
-                                 return_offsets_mapping=True)
-            word_ids = encoding.word_ids()
-
-            input_ids = torch.tensor([encoding["input_ids"]]).to(model.device)
-            attention_mask = torch.tensor([encoding["attention_mask"]]).to(model.device)
-            with torch.no_grad():
-                pos_logits, dep_logits, head_logits, _ = model(input_ids, attention_mask,
-                                                               pos_labels=None, dep_labels=None, head_labels=None)
-            pos_preds = pos_logits.argmax(dim=-1).squeeze(0).tolist()
-            dep_preds = dep_logits.argmax(dim=-1).squeeze(0).tolist()
-            pred_pos = {}
-            pred_dep = {}
-            for idx, word_idx in enumerate(word_ids):
-                if word_idx is None:
-                    continue
-                if word_idx not in pred_pos:
-                    pred_pos[word_idx] = pos_preds[idx]
-                    pred_dep[word_idx] = dep_preds[idx]
-            pos_tags = [id2pos_label.get(pred_pos[i], "UNK") for i in range(len(words))]
-            dep_tags = [id2dep_label.get(pred_dep[i], "UNK") for i in range(len(words))]
-            fout.write(sentence + "\t" + " ".join(pos_tags) + "\t" + " ".join(dep_tags) + "\n")
+    engine = AnnotationEngine(model, tokenizer, pos_label2id, dep_label2id, max_length=config.max_length,
+                              batch_size=config.batch_size)
+    with open(tsv_file, "r", encoding="utf-8") as fin, open_output(output_file, pos_label2id, dep_label2id) as fout:
+        engine.annotate(read_xnli_sentences(fin), fout, keep_missing=True)
 
 def compute_accuracy(test_dataset, model, tokenizer, config, pos_label2id, dep_label2id):
-    test_dataset = UDParsingDataset(test_dataset, tokenizer, 
-                                    pos_label2id=pos_label2id, 
-                                    dep_label2id=dep_label2id,
-                                    max_length=config.max_length)
-    model.eval()
-    total_pos_tokens = 0
-    correct_pos = 0
-    total_dep_tokens = 0
-    correct_dep = 0
-    device = model.device
+    results = evaluate_parser(test_dataset, None, model, tokenizer, config, pos_label2id, dep_label2id)
+    return results["pos_accuracy"], results["dep_accuracy"]
 
-    with torch.no_grad():
-        for example in test_dataset:
-            input_ids = example["input_ids"].unsqueeze(0).to(device)
-            attention_mask = example["attention_mask"].unsqueeze(0).to(device)
-            gold_pos = example["pos_labels"].to(device) 
-            gold_dep = example["dep_labels"].to(device)
-            
-            pos_logits, dep_logits, head_logits, _ = model(input_ids, attention_mask,
-                                                           pos_labels=None, dep_labels=None, head_labels=None)
-
-            pos_preds = pos_logits.argmax(dim=-1).squeeze(0) 
-            dep_preds = dep_logits.argmax(dim=-1).squeeze(0)
-            
-            mask = (gold_pos != -100)
-            total_pos_tokens += mask.sum().item()
-            correct_pos += ((pos_preds == gold_pos) & mask).sum().item()
-
-            mask_dep = (gold_dep != -100)
-            total_dep_tokens += mask_dep.sum().item()
-            correct_dep += ((dep_preds == gold_dep) & mask_dep).sum().item()
-    
-    pos_accuracy = correct_pos / total_pos_tokens if total_pos_tokens > 0 else 0
-    dep_accuracy = correct_dep / total_dep_tokens if total_dep_tokens > 0 else 0
-    return pos_accuracy, dep_accuracy
+def print_results(results):
+    print("POS Accuracy: {:.2f}%".format(results["pos_accuracy"] * 100))
+    print("Dependency Accuracy: {:.2f}%".format(results["dep_accuracy"] * 100))
+    print("Head Attachment Accuracy (UAS): {:.2f}%".format(results["uas"] * 100))
 
 def main():
     parser = argparse.ArgumentParser()
@@ -128,6 +123,10 @@ def main():
     parser.add_argument("--output_file", type=str, help="Path to save the annotated output")
     parser.add_argument("--model_path", type=str, required=True, help="Path to the fine-tuned model state dict")
     parser.add_argument("--max_length", type=int, default=128)
+    parser.add_argument("--batch_size", type=int, default=64, help="sentences per forward pass")
+    parser.add_argument("--confusion_prefix", type=str, default=None,
+                        help="also write gold x predicted POS/DEP confusion counts to <prefix>.pos.tsv / <prefix>.dep.tsv")
+    parser.add_argument("--cache_dir", type=str, default=None, help="where encoded CoNLL-U files are cached")
     args = parser.parse_args()
 
     tokenizer = BertTokenizerFast.from_pretrained("bert-base-multilingual-cased")
@@ -151,20 +150,20 @@ def main():
         pass
     config = Config()
     config.max_length = args.max_length
-
-    if args.mode == "eval_finetuned":
-        evaluate_finetuned(args.input_file, args.output_file, model, tokenizer, config, pos_label2id, dep_label2id)
+    config.batch_size = args.batch_size
+    config.cache_dir = args.cache_dir
+
+    if args.mode in {"eval_finetuned", "eval_unfinetuned", "compute_accuracy"}:
+        # one pass writes the predictions (unless only scoring) and computes every metric
+        output_file = None if args.mode == "compute_accuracy" else args.output_file
+        results = evaluate_parser(args.input_file, output_file, model, tokenizer, config, pos_label2id, dep_label2id,
+                                  confusion=args.confusion_prefix is not None)
+        print_results(results)
+        if args.confusion_prefix is not None:
+            write_confusion(args.confusion_prefix + ".pos.tsv", results["pos_confusion"], {v: k for k, v in pos_label2id.items()})
+            write_confusion(args.confusion_prefix + ".dep.tsv", results["dep_confusion"], {v: k for k, v in dep_label2id.items()})
     elif args.mode == "annotate_xnli":
         annotate_xnli(args.input_file, args.output_file, model, tokenizer, config, pos_label2id, dep_label2id)
-    elif args.mode == "compute_accuracy":
-        pos_acc, dep_acc = compute_accuracy(args.input_file, model, tokenizer, config, pos_label2id, dep_label2id)
-        print("POS Accuracy: {:.2f}%".format(pos_acc * 100))
-        print("Dependency Accuracy: {:.2f}%".format(dep_acc * 100))
-    if args.mode == "eval_unfinetuned":
-        evaluate_finetuned(args.input_file, args.output_file, model, tokenizer, config, pos_label2id, dep_label2id)
-        pos_acc, dep_acc = compute_accuracy(args.input_file, model, tokenizer, config, pos_label2id, dep_label2id)
-        print("POS Accuracy: {:.2f}%".format(pos_acc * 100))
-        print("Dependency Accuracy: {:.2f}%".format(dep_acc * 100))
 
 if __name__ == "__main__":
     main()
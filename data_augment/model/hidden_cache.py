@@ -0,0 +1,102 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+# Frozen-encoder cache for head-only experiments. The encoder runs once over a
+# UDParsingDataset and last_hidden_state for the non-pad positions is written
+# to a float16 memmap (<path>.f16), with per-sentence offsets and the aligned
+# labels next to it (<path>.npz). HiddenStateDataset reads it back so Trainer
+# only runs the POS/DEP/head classifiers.
+
+def dataset_fingerprint(dataset):
+    digest = hashlib.sha1()
+    for array in (dataset.input_ids, dataset.attention_mask, dataset.pos_labels, dataset.dep_labels, dataset.head_labels):
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()
+
+
+def build_hidden_cache(encoder, dataset, path, device="cpu", batch_size=64, encoder_name=""):
+    """Run `encoder` (a BertModel) over `dataset` and cache its non-pad hidden states at `path`; no-op if up to date."""
+    fingerprint = json.dumps([dataset_fingerprint(dataset), encoder_name])
+    meta_path = path + ".npz"
+    if os.path.exists(meta_path) and os.path.exists(path + ".f16"):
+        if str(np.load(meta_path)["fingerprint"]) == fingerprint:
+            return path
+
+    # right-padded, so the first `length` positions of each row are the real tokens
+    lengths = np.asarray(dataset.attention_mask, dtype=np.int64).sum(axis=1)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    hidden_size = encoder.config.hidden_size
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    hidden = np.lib.format.open_memmap(path + ".f16.tmp", mode="w+", dtype=np.float16, shape=(int(offsets[-1]), hidden_size))
+
+    encoder.eval()
+    with torch.no_grad():
+        for bgn in range(0, len(dataset), batch_size):
+            end = min(bgn + batch_size, len(dataset))
+            width = int(lengths[bgn:end].max())
+            input_ids = torch.from_numpy(np.asarray(dataset.input_ids[bgn:end, :width], dtype=np.int64)).to(device)
+            attention_mask = torch.from_numpy(np.asarray(dataset.attention_mask[bgn:end, :width], dtype=np.int64)).to(device)
+            states = encoder(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+            states = states[attention_mask.bool()].to(torch.float16).cpu().numpy()
+            hidden[offsets[bgn] : offsets[end]] = states
+    hidden.flush()
+    del hidden
+    os.replace(path + ".f16.tmp", path + ".f16")
+
+    keep = np.arange(dataset.input_ids.shape[1])[None, :] < lengths[:, None]
+    np.savez(meta_path + ".tmp.npz", fingerprint=fingerprint, offsets=offsets,
+             pos_labels=np.asarray(dataset.pos_labels)[keep],
+             dep_labels=np.asarray(dataset.dep_labels)[keep],
+             head_labels=np.asarray(dataset.head_labels)[keep])
+    os.replace(meta_path + ".tmp.npz", meta_path)
+    return path
+
+
+class HiddenStateDataset(Dataset):
+    def __init__(self, path):
+        self.hidden = np.load(path + ".f16", mmap_mode="r")
+        meta = np.load(path + ".npz")
+        self.offsets = meta["offsets"]
+        self.pos_labels = meta["pos_labels"]
+        self.dep_labels = meta["dep_labels"]
+        self.head_labels = meta["head_labels"]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def __getitem__(self, idx):
+        bgn, end = self.offsets[idx], self.offsets[idx + 1]
+        return {
+            "hidden_states": torch.from_numpy(np.asarray(self.hidden[bgn:end], dtype=np.float32)),
+            "pos_labels": torch.from_numpy(self.pos_labels[bgn:end]).long(),
+            "dep_labels": torch.from_numpy(self.dep_labels[bgn:end]).long(),
+            "head_labels": torch.from_numpy(self.head_labels[bgn:end]).long(),
+        }
+
+
+def collate_hidden_states(batch):
+    # pad to the longest sentence in the batch; padded positions are masked out of the loss with -100
+    width = max(len(ex["pos_labels"]) for ex in batch)
+    hidden_size = batch[0]["hidden_states"].shape[-1]
+    out = {
+        "hidden_states": torch.zeros(len(batch), width, hidden_size),
+        "attention_mask": torch.zeros(len(batch), width, dtype=torch.long),
+        "pos_labels": torch.full((len(batch), width), -100, dtype=torch.long),
+        "dep_labels": torch.full((len(batch), width), -100, dtype=torch.long),
+        "head_labels": torch.full((len(batch), width), -100, dtype=torch.long),
+    }
+    for i, ex in enumerate(batch):
+        n = len(ex["pos_labels"])
+        out["hidden_states"][i, :n] = ex["hidden_states"]
+        out["attention_mask"][i, :n] = 1
+        for key in ("pos_labels", "dep_labels", "head_labels"):
+            out[key][i, :n] = ex[key]
+    return out
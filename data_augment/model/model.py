@@ -13,10 +13,12 @@ class BertForParsing(nn.Module):
         self.head_classifier = nn.Linear(hidden_size, max_length)
         self.max_length = max_length
     
-    def forward(self, input_ids, attention_mask, pos_labels=None, dep_labels=None, head_labels=None):
-        outputs = self.bert(input_ids=input_ids, attention_mask=attention_mask)
-        sequence_output = outputs.last_hidden_state  # shape: (batch, seq_len, hidden_size)
-        sequence_output = self.dropout(sequence_output)
+    def forward(self, input_ids, attention_mask, pos_labels=None, dep_labels=None, head_labels=None, hidden_states=None):
+        if hidden_states is None:
+            outputs = self.bert(input_ids=input_ids, attention_mask=attention_mask)
+            hidden_states = outputs.last_hidden_state  # shape: (batch, seq_len, hidden_size)
+        # else: precomputed encoder output from a frozen-encoder cache (see hidden_cache.py), only the heads run
+        sequence_output = self.dropout(hidden_states)
         pos_logits = self.pos_classifier(sequence_output)
         dep_logits = self.dep_classifier(sequence_output)
         head_logits = self.head_classifier(sequence_output)
@@ -6,21 +6,44 @@ from transformers import BertTokenizerFast
 from torch.utils.tensorboard import SummaryWriter
 from model import BertForParsing
 from trainer import Trainer, TrainerConfig
+from hidden_cache import HiddenStateDataset, build_hidden_cache, collate_hidden_states
 
 import os
-os.environ["TOKENIZERS_PARALLELISM"] = "false"
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from util.distributed import barrier, cleanup, init_distributed, is_main_process
+
+# tokenization happens once in the main process before the loaders start; the persistent workers only
+# index pre-encoded arrays, so the tokenizer's own thread pool can stay on
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "true")
 
 def main():
     argp = argparse.ArgumentParser()
-    argp.add_argument("--train_file", type=str, required=True)
-    argp.add_argument("--dev_file", type=str, required=True)
+    argp.add_argument("--train_file", type=str, nargs="+", required=True, help="one or more CoNLL-U treebanks")
+    argp.add_argument("--dev_file", type=str, nargs="+", required=True)
     argp.add_argument("--output_model", type=str, required=True)
     argp.add_argument("--max_length", type=int, default=128)
     argp.add_argument("--max_epochs", type=int, default=10)
     argp.add_argument("--batch_size", type=int, default=32)
     argp.add_argument("--learning_rate", type=float, default=3e-5)
+    argp.add_argument("--cache_dir", type=str, default=None, help="where encoded treebanks are cached (default: next to the data)")
+    argp.add_argument("--freeze_encoder", action="store_true",
+                      help="train only the POS/DEP/head classifiers from cached mBERT hidden states")
+    argp.add_argument("--hidden_cache_dir", type=str, default="hidden_cache", help="where --freeze_encoder caches hidden states")
+    argp.add_argument("--sync_free", action="store_true",
+                      help="accumulate loss on device and log every --log_every steps from a background thread")
+    argp.add_argument("--log_every", type=int, default=50)
+    argp.add_argument("--precision", choices=["fp32", "bf16"], default="fp32")
+    argp.add_argument("--grad_accum_steps", type=int, default=1, help="batches per optimizer step")
+    argp.add_argument("--gradient_checkpointing", action="store_true", help="recompute mBERT activations in backward")
+    argp.add_argument("--num_workers", type=int, default=4, help="persistent DataLoader workers")
+    argp.add_argument("--length_bucketing", action="store_true",
+                      help="batch sentences of similar length and trim each batch to its longest sentence")
     args = argp.parse_args()
 
+    # no-op unless launched with torchrun, e.g. torchrun --standalone --nproc_per_node 4 model/run.py ...
+    init_distributed()
+
     device = 'cpu'
     if torch.cuda.is_available():
         device = torch.cuda.current_device()
@@ -28,20 +51,28 @@ def main():
         device = 'mps'
 
     # TensorBoard training log
-    writer = SummaryWriter(log_dir='expt/%s/%s_%s_pt_lr_%f_ft_lr_%f' % (
-        args.train_file,
-        args.dev_file,
-        args.output_model,
-        args.batch_size,
-        args.learning_rate))
+    writer = None
+    if is_main_process():
+        writer = SummaryWriter(log_dir='expt/%s/%s_%s_pt_lr_%f_ft_lr_%f' % (
+            "+".join(args.train_file),
+            "+".join(args.dev_file),
+            args.output_model,
+            args.batch_size,
+            args.learning_rate))
     
     tokenizer = BertTokenizerFast.from_pretrained("bert-base-multilingual-cased")
     
-    train_dataset = dataset.UDParsingDataset(args.train_file, tokenizer, max_length=args.max_length)
+    # rank 0 encodes and caches the treebanks, the other ranks then load its cache
+    if not is_main_process():
+        barrier()
+    train_dataset = dataset.UDParsingDataset(args.train_file, tokenizer, max_length=args.max_length, cache_dir=args.cache_dir)
     dev_dataset = dataset.UDParsingDataset(args.dev_file, tokenizer, 
                                    pos_label2id=train_dataset.pos_label2id, 
                                    dep_label2id=train_dataset.dep_label2id, 
-                                   max_length=args.max_length)
+                                   max_length=args.max_length,
+                                   cache_dir=args.cache_dir)
+    if is_main_process():
+        barrier()
     
     num_pos_labels = len(train_dataset.pos_label2id)
     num_dep_labels = len(train_dataset.dep_label2id)
@@ -51,10 +82,37 @@ def main():
 
     model = BertForParsing(num_pos_labels, num_dep_labels, max_length=128, pretrained_model_name="bert-base-multilingual-cased")
     
+    collate_fn = dataset.collate_trim_padding if args.length_bucketing else None
+    train_data, dev_data = train_dataset, dev_dataset
+    if args.freeze_encoder:
+        # run the encoder once, then the heads train from the float16 cache
+        # (on rank 0 only under torchrun; the other ranks map the same files)
+        model.bert.requires_grad_(False)
+        train_cache = os.path.join(args.hidden_cache_dir, "train")
+        dev_cache = os.path.join(args.hidden_cache_dir, "dev")
+        if is_main_process():
+            model.bert.to(device)
+            build_hidden_cache(model.bert, train_dataset, train_cache, device=device, batch_size=args.batch_size,
+                               encoder_name="bert-base-multilingual-cased")
+            build_hidden_cache(model.bert, dev_dataset, dev_cache, device=device, batch_size=args.batch_size,
+                               encoder_name="bert-base-multilingual-cased")
+            model.bert.to("cpu")
+        barrier()
+        train_data = HiddenStateDataset(train_cache)
+        dev_data = HiddenStateDataset(dev_cache)
+        collate_fn = collate_hidden_states
+
+    # the LR schedule counts real tokens; these budgets were set for every example padded to 128 positions
+    real_fraction = float(train_dataset.lengths().sum()) / (len(train_dataset) * 128)
     trainer_config = TrainerConfig(max_epochs=args.max_epochs, batch_size=args.batch_size, learning_rate=args.learning_rate,
-                                   lr_decay=True, warmup_tokens=512*20, final_tokens=200*len(train_dataset)*128,
-                                   num_workers=4, writer=writer)
-    trainer = Trainer(model, train_dataset, dev_dataset, trainer_config)
+                                   lr_decay=True, warmup_tokens=512*20*real_fraction,
+                                   final_tokens=200*len(train_dataset)*128*real_fraction,
+                                   num_workers=args.num_workers, writer=writer, collate_fn=collate_fn,
+                                   length_bucketing=args.length_bucketing,
+                                   sync_free=args.sync_free, log_every=args.log_every,
+                                   precision=args.precision, grad_accum_steps=args.grad_accum_steps,
+                                   gradient_checkpointing=args.gradient_checkpointing)
+    trainer = Trainer(model, train_data, dev_data, trainer_config)
     
     trainer.train()
     
@@ -65,9 +123,11 @@ def main():
         "dep_label2id": train_dataset.dep_label2id,
         "max_length": args.max_length,
     }
-    torch.save(model_and_labels, args.output_model)
-
-    print("Model saved to", args.output_model)
+    # model is the unwrapped BertForParsing; only rank 0 writes it
+    if is_main_process():
+        torch.save(model_and_labels, args.output_model)
+        print("Model saved to", args.output_model)
+    cleanup()
     
 if __name__ == "__main__":
     main()
@@ -0,0 +1,259 @@
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+
+import torch
+from transformers import BertTokenizerFast
+from model import BertForParsing
+from annotation import AnnotationEngine
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from util.annotation_store import SUFFIX as STORE_SUFFIX, tsv_to_store
+import annotate
+import annotate_hinglish
+import evaluate
+
+# Sharded, resumable corpus annotation. The input is split into line-aligned
+# byte ranges, one per shard (record-aligned for the XNLI TSV, where a quoted
+# field may span lines, so every shard parses exactly as the whole file would), and a pool of forked workers (each with its own
+# torch thread budget, sharing the parent's model memory) annotates them with
+# AnnotationEngine. After every chunk a worker flushes its shard output and
+# records the input offset and output size it has completed, so a restarted
+# job truncates each shard to its last checkpoint and carries on from there.
+# Finished shards are concatenated in order into the final output file, or
+# packed into an annotation store when it ends in .anno.
+#
+#   python model/shard_annotate.py --format tico --lang zh --input_file ... --output_file ... --model_path fine_tuned_bert.pt --workers 4
+#   python model/shard_annotate.py --format xnli --input_file datasets/xnli/xnli.test.tsv --output_file outputs/xnli_annotated_test.txt --model_path fine_tuned_bert.pt --workers 4
+
+FORMATS = ("tico", "hinglish", "xnli")
+
+_WORKER = {}
+
+
+def read_records(path, bgn, end, multiline=False):
+    # yield (decoded lines of one record, offset after it) for the byte range [bgn, end); with
+    # multiline, lines are grouped the way csv.reader groups them (quoted fields may hold newlines)
+    with open(path, "rb") as f:
+        f.seek(bgn)
+        pending = []
+
+        def lines():
+            while f.tell() < end:
+                line = f.readline()
+                if not line:
+                    return
+                pending.append(line.decode("utf-8"))
+                yield pending[-1]
+
+        if multiline:
+            for _ in csv.reader(lines(), delimiter="\t"):
+                yield pending[:], f.tell()
+                del pending[:]
+        else:
+            for _ in lines():
+                yield pending[:], f.tell()
+                del pending[:]
+
+
+def shard_ranges(path, shards, start=0, multiline=False):
+    # split [start, size) into `shards` byte ranges that begin and end on line (or record) boundaries
+    size = os.path.getsize(path)
+    bounds = [start]
+    if multiline:
+        # one csv pass over the file; each bound is the first record boundary past its target
+        targets = [start + (size - start) * k // shards for k in range(1, shards)]
+        for _, offset in read_records(path, start, size, multiline=True):
+            while targets and offset >= targets[0]:
+                targets.pop(0)
+                bounds.append(offset)
+        bounds.extend([size] * len(targets))
+        bounds.append(size)
+        return [(bgn, end) for bgn, end in zip(bounds[:-1], bounds[1:])]
+    with open(path, "rb") as f:
+        for k in range(1, shards):
+            f.seek(max(start + (size - start) * k // shards, bounds[-1]))
+            if f.tell() > start:
+                f.seek(f.tell() - 1)
+                f.readline()
+            bounds.append(min(f.tell(), size))
+    bounds.append(size)
+    return [(bgn, end) for bgn, end in zip(bounds[:-1], bounds[1:])]
+
+
+def read_chunks(path, bgn, end, chunk_lines, multiline=False):
+    # yield (decoded lines, offset after the last line) for the byte range [bgn, end), never splitting a record
+    lines = []
+    for record, offset in read_records(path, bgn, end, multiline):
+        lines.extend(record)
+        if len(lines) >= chunk_lines:
+            yield lines, offset
+            lines = []
+    if lines:
+        yield lines, offset
+
+
+def parse(lines, fmt, lang=None, fieldnames=None):
+    if fmt == "tico":
+        return list(annotate.read_sentences(lines, lang))
+    if fmt == "hinglish":
+        return list(annotate_hinglish.read_sentences(lines))
+    return list(evaluate.read_xnli_sentences(lines, fieldnames))
+
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_checkpoint(path, state):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+def _init_worker(engine, options, threads):
+    torch.set_num_threads(threads)
+    # inherited through fork, only shard ids cross the process boundary
+    _WORKER["engine"] = engine
+    _WORKER["options"] = options
+
+
+def _annotate_shard(shard):
+    engine = _WORKER["engine"]
+    opts = _WORKER["options"]
+    shard_id, bgn, end = shard
+    out_path = os.path.join(opts["work_dir"], "%05d.tsv" % shard_id)
+    ckpt_path = out_path + ".ckpt"
+    state = load_checkpoint(ckpt_path) or {"offset": bgn, "out_size": 0, "done": False}
+    if state["done"]:
+        return shard_id, 0
+
+    count = 0
+    with open(out_path, "a", encoding="utf-8") as fout:
+        # drop anything written after the last checkpoint
+        fout.truncate(state["out_size"])
+        fout.seek(state["out_size"])
+        for lines, offset in read_chunks(opts["input_file"], state["offset"], end, engine.chunk_size,
+                                         multiline=opts["format"] == "xnli"):
+            items = parse(lines, opts["format"], opts["lang"], opts["fieldnames"])
+            if items:
+                count += engine.write_chunk(items, fout, opts["keep_missing"])
+            fout.flush()
+            os.fsync(fout.fileno())
+            state = {"offset": offset, "out_size": fout.tell(), "done": False}
+            save_checkpoint(ckpt_path, state)
+    state["done"] = True
+    save_checkpoint(ckpt_path, state)
+    return shard_id, count
+
+
+def plan_shards(input_file, work_dir, shards, fmt):
+    # the shard plan is fixed on the first run so a resumed job sees the same ranges
+    plan_path = os.path.join(work_dir, "plan.json")
+    stat = os.stat(input_file)
+    plan = load_checkpoint(plan_path)
+    if plan is not None and plan["size"] == stat.st_size and plan["mtime_ns"] == stat.st_mtime_ns:
+        return plan
+    if os.path.isdir(work_dir):
+        shutil.rmtree(work_dir)
+    os.makedirs(work_dir)
+
+    start, fieldnames = 0, None
+    if fmt == "xnli":
+        with open(input_file, "rb") as f:
+            header = f.readline()
+        start = len(header)
+        fieldnames = header.decode("utf-8").rstrip("\r\n").split("\t")
+    plan = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "fieldnames": fieldnames,
+            "ranges": shard_ranges(input_file, shards, start, multiline=fmt == "xnli")}
+    save_checkpoint(plan_path, plan)
+    return plan
+
+
+def annotate_sharded(input_file, output_file, engine, fmt, lang=None, workers=1, threads=None, shards=None):
+    work_dir = output_file + ".shards"
+    plan = plan_shards(input_file, work_dir, shards or workers, fmt)
+    options = {
+        "input_file": input_file,
+        "work_dir": work_dir,
+        "format": fmt,
+        "lang": lang,
+        "fieldnames": plan["fieldnames"],
+        # annotate_xnli emits UNK for words lost to truncation
+        "keep_missing": fmt == "xnli",
+    }
+    jobs = [(k, bgn, end) for k, (bgn, end) in enumerate(plan["ranges"])]
+    threads = threads or max(1, (os.cpu_count() or 1) // workers)
+
+    start = time.time()
+    total = 0
+    if workers <= 1:
+        _init_worker(engine, options, threads)
+        for job in jobs:
+            total += _annotate_shard(job)[1]
+    else:
+        context = multiprocessing.get_context("fork")
+        with context.Pool(workers, initializer=_init_worker, initargs=(engine, options, threads)) as pool:
+            for shard_id, count in pool.imap_unordered(_annotate_shard, jobs):
+                total += count
+                print("Shard %d done (%d sentences)" % (shard_id, count))
+    print("Annotated %d sentences in %.1fs" % (total, time.time() - start))
+
+    # ordered merge, then the shard files are no longer needed
+    shard_files = [os.path.join(work_dir, "%05d.tsv" % shard_id) for shard_id, _, _ in jobs]
+    if output_file.endswith(STORE_SUFFIX):
+        tsv_to_store(shard_files, output_file)
+    else:
+        tmp_output = output_file + ".tmp"
+        with open(tmp_output, "wb") as fout:
+            for shard_file in shard_files:
+                with open(shard_file, "rb") as fin:
+                    shutil.copyfileobj(fin, fout)
+        os.replace(tmp_output, output_file)
+    shutil.rmtree(work_dir)
+
+
+def load_model(model_path):
+    state_dict = torch.load(model_path, map_location=torch.device('cpu'))
+    pos_label2id = state_dict["pos_label2id"]
+    dep_label2id = state_dict["dep_label2id"]
+    model = BertForParsing(len(pos_label2id), len(dep_label2id), max_length=state_dict["max_length"])
+    model.load_state_dict(state_dict["model_state_dict"])
+    return model, pos_label2id, dep_label2id
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--format", choices=FORMATS, required=True,
+                        help="tico: one sentence per line (annotate.py), hinglish: first TSV column, xnli: XNLI TSV")
+    parser.add_argument("--lang", type=str, default="en", help="word splitting for --format tico (zh splits characters)")
+    parser.add_argument("--input_file", type=str, required=True)
+    parser.add_argument("--output_file", type=str, required=True)
+    parser.add_argument("--model_path", type=str, required=True, help="Path to the fine-tuned model state dict")
+    parser.add_argument("--max_length", type=int, default=128)
+    parser.add_argument("--batch_size", type=int, default=64, help="sentences per forward pass")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--threads", type=int, default=None, help="torch threads per worker (default: cores / workers)")
+    parser.add_argument("--shards", type=int, default=None, help="number of byte-range shards (default: workers)")
+    args = parser.parse_args()
+
+    tokenizer = BertTokenizerFast.from_pretrained("bert-base-multilingual-cased")
+    model, pos_label2id, dep_label2id = load_model(args.model_path)
+    model.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    if model.device.type == "cuda":
+        args.workers = 1
+    model.to(model.device)
+
+    engine = AnnotationEngine(model, tokenizer, pos_label2id, dep_label2id, max_length=args.max_length,
+                              batch_size=args.batch_size)
+    annotate_sharded(args.input_file, args.output_file, engine, args.format, args.lang,
+                     args.workers, args.threads, args.shards)
@@ -4,4 +4,6 @@
 python model/evaluate.py --mode annotate_xnli --input_file datasets/xnli/xnli.test.tsv --output_file outputs/xnli_annotated_test.txt --model_path fine_tuned_bert.pt
 
 # annotate XNLI dataset - dev
-# python model/evaluate.py --mode annotate_xnli --input_file datasets/xnli/xnli.dev.tsv --output_file outputs/xnli_annotated_dev.txt --model_path fine_tuned_bert.pt
\ No newline at end of file
+# python model/evaluate.py --mode annotate_xnli --input_file datasets/xnli/xnli.dev.tsv --output_file outputs/xnli_annotated_dev.txt --model_path fine_tuned_bert.pt
+# annotate XNLI dataset - test, sharded over 4 processes (rerun the same command to resume)
+# python model/shard_annotate.py --format xnli --input_file datasets/xnli/xnli.test.tsv --output_file outputs/xnli_annotated_test.txt --model_path fine_tuned_bert.pt --workers 4
@@ -1,4 +1,7 @@
 ##! /bin/bash
 
 # Pretrain the model
-python model/run.py --train_file datasets/ud/combined_train.conllu --dev_file datasets/ud/combined_dev.conllu --output_model fine_tuned_bert.pt
\ No newline at end of file
+python model/run.py --train_file datasets/ud/combined_train.conllu --dev_file datasets/ud/combined_dev.conllu --output_model fine_tuned_bert.pt
+
+# data-parallel over 4 processes (gloo on CPU, one GPU each otherwise)
+# torchrun --standalone --nproc_per_node 4 model/run.py --train_file datasets/ud/combined_train.conllu --dev_file datasets/ud/combined_dev.conllu --output_model fine_tuned_bert.pt
\ No newline at end of file
@@ -1,3 +1,6 @@
 ##! /bin/bash
 
-python codeswitch_model/model.py --step 2
\ No newline at end of file
+python codeswitch_model/model.py --step 2
+
+# data-parallel over 4 processes
+# torchrun --standalone --nproc_per_node 4 codeswitch_model/model.py --step 2
\ No newline at end of file
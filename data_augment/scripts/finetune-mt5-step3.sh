@@ -1,3 +1,11 @@
 ##! /bin/bash
 
-python codeswitch_model/model.py --step 3
\ No newline at end of file
+python codeswitch_model/model.py --step 3
+
+# codeswitch a text file, one output line per input line (rerun the same command to resume)
+# python codeswitch_model/model.py --step 3 --input_file dataset/enghinglish/test.txt --output_file outputs/codeswitched_hinglish_en_test-3.txt --num_beams 5 --max_new_tokens 128
+
+# CPU profile: int8 linears, greedy, new tokens capped at 1.5x the input (check agreement first with codeswitch_model/generation_benchmark.py)
+# python codeswitch_model/model.py --step 3 --cpu_int8 --num_beams 1 --max_length_ratio 1.5 --threads 8
+# XNLI over 8 CPU worker processes sharing one copy of the weights (rerun with the same --output_file to resume)
+# python codeswitch_model/shard_generate.py --workers 8 --threads 4 --cpu_int8 --num_beams 1 --max_length_ratio 1.5
@@ -1,30 +1,82 @@
-from indic_transliteration import sanscript
-from indic_transliteration.sanscript import transliterate
+import heapq
+import multiprocessing
+import os
+import sys
+import tempfile
 
-def load_data(file_path):
-    """Load data from a file and return a set of unique (English, Hindi) word pairs."""
-    word_pairs = set()
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+import util.dictionary
+from util.transliterate import TransliterationCache, romanize_many
+
+CHUNK_LINES = 100000  # input lines transliterated per batch
+RUN_PAIRS = 1000000   # pairs held in memory before spilling a sorted run
+
+
+def read_chunks(file_path, chunk_lines=CHUNK_LINES):
+    """Yield lists of (English, Hindi) word pairs from a tab-separated file."""
+    chunk = []
     with open(file_path, "r", encoding="utf-8") as file:
         for line in file:
             parts = line.strip().split("\t")  # Assuming tab-separated values
             if len(parts) == 2:
-                english, hindi = parts
-                # Transliterate Hindi to Romanized Hindi and normalize both words to lowercase
-                romanized_hindi = transliterate(hindi, sanscript.DEVANAGARI, sanscript.ITRANS).lower()
-                word_pairs.add((english.lower(), romanized_hindi))  # Store as a set to remove duplicates
-    return word_pairs
+                chunk.append(parts)
+                if len(chunk) == chunk_lines:
+                    yield chunk
+                    chunk = []
+    if chunk:
+        yield chunk
+
+
+def spill(pairs, tmp_dir):
+    """Write one sorted, deduplicated run to disk and return its path."""
+    fd, path = tempfile.mkstemp(suffix=".run", dir=tmp_dir)
+    with os.fdopen(fd, "w", encoding="utf-8") as run:
+        for english, hindi in sorted(set(pairs)):
+            run.write(f"{english}\t{hindi}\n")
+    return path
+
+
+def read_run(path):
+    with open(path, "r", encoding="utf-8") as run:
+        for line in run:
+            yield tuple(line.rstrip("\n").split("\t"))
+
+
+def build_dictionary(file_paths, output_path, cache, pool, tmp_dir):
+    """Transliterate, dedupe and externally sort (English, romanized Hindi) pairs."""
+    runs = []
+    pairs = []
+    for file_path in file_paths:
+        for chunk in read_chunks(file_path):
+            # each unique Hindi form is transliterated once, memoized across runs
+            romanized = romanize_many((hindi for _, hindi in chunk), cache, pool)
+            pairs.extend((english.lower(), romanized[hindi].lower()) for english, hindi in chunk)
+            if len(pairs) >= RUN_PAIRS:
+                runs.append(spill(pairs, tmp_dir))
+                pairs = []
+    if pairs:
+        runs.append(spill(pairs, tmp_dir))
 
-# Load data from both files
-file1_data = load_data("dataset/Panlex/hi2.txt")
-file2_data = load_data("dataset/Panlex/crowd_transliterations.hi-en.txt")
+    # k-way merge of the sorted runs; duplicates (within and across runs) end up adjacent
+    previous = None
+    with open(output_path, "w", encoding="utf-8") as out_file:
+        for pair in heapq.merge(*[read_run(run) for run in runs]):
+            if pair != previous:
+                out_file.write(f"{pair[0]}\t{pair[1]}\n")
+                previous = pair
+    for run in runs:
+        os.remove(run)
 
 
-# Combine both lists
-combined_data = file1_data.union(file2_data)
+if __name__ == "__main__":
+    cache = TransliterationCache()
+    with multiprocessing.Pool() as pool, tempfile.TemporaryDirectory() as tmp_dir:
+        build_dictionary(["dataset/Panlex/hi2.txt", "dataset/Panlex/crowd_transliterations.hi-en.txt"],
+                         "en-hi-romanized-dict.txt", cache, pool, tmp_dir)
+    cache.close()
 
-# Write each pair on a new line
-with open("en-hi-romanized-dict.txt", "w", encoding="utf-8") as out_file:
-    for english, hindi in sorted(combined_data):
-        out_file.write(f"{english}\t{hindi}\n")
+    print("Mered file saved")
 
-print("Mered file saved")
+    # compiled, mmap-able copy read by util.dictionary.load
+    util.dictionary.DictCompiler.compile("en-hi-romanized-dict.txt")
+    print("Compiled dictionary saved")
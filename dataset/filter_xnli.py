@@ -1,22 +1,88 @@
-import pandas as pd
+import argparse
 import os
+import sys
 
-def extract_hindi_xnli(input_file, output_file):
-    df = pd.read_csv(input_file, delimiter='\t')
-    hindi_df = df[df['language'] == 'hi']
-    hindi_df.to_csv(output_file, sep='\t', index=False)
-    print(f"Extracted {len(hindi_df)} Hindi sentences and saved to {output_file}")
-
-def extract_english_xnli(input_file, output_file):
-    df = pd.read_csv(input_file, delimiter='\t')
-    english_df = df[df['language'] == 'en']
-    english_df.to_csv(output_file, sep='\t', index=False)
-    print(f"Extracted {len(english_df)} English sentences and saved to {output_file}")
+# Streaming XNLI language partitioner: reads an XNLI-format TSV once, in
+# chunks, and writes every language (or the requested subset) to its own
+# TSV at the same time, optionally also filling the columnar store read by
+# util/dataset/XNLI/all.py. Memory stays constant in the input size.
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-print(BASE_DIR)
-input_xnli_path = os.path.join(BASE_DIR, "./XNLI/xnli.dev.tsv")
-output_hindi_path = os.path.join(BASE_DIR, "./XNLI/xnli.hindi.dev.tsv")
-output_english_path = os.path.join(BASE_DIR, "./XNLI/xnli.english.dev.tsv")
-extract_hindi_xnli(input_xnli_path, output_hindi_path)
-extract_english_xnli(input_xnli_path, output_english_path)
+sys.path.append(os.path.join(BASE_DIR, ".."))
+
+LANGUAGE_NAMES = {
+    "ar": "arabic", "bg": "bulgarian", "de": "german", "el": "greek", "en": "english",
+    "es": "spanish", "fr": "french", "hi": "hindi", "ru": "russian", "sw": "swahili",
+    "th": "thai", "tr": "turkish", "ur": "urdu", "vi": "vietnamese", "zh": "chinese",
+}
+CHUNK_SIZE = 1 << 20
+# XNLI file suffixes that the store (and the HF hub) name differently
+STORE_SPLIT_NAMES = {"dev": "validation"}
+
+
+def output_path(output_dir, lang, split):
+    return os.path.join(output_dir, "xnli.{}.{}.tsv".format(LANGUAGE_NAMES.get(lang, lang), split))
+
+
+def read_chunks(reader, chunk_size=CHUNK_SIZE):
+    while True:
+        lines = reader.readlines(chunk_size)
+        if not lines:
+            break
+        yield lines
+
+
+def partition_xnli(input_file, output_dir, split, languages=None, store_root=None, store_split=None):
+    if store_root is not None:
+        from util.dataset.XNLI.store import SPLITS, StoreWriter, store_dir, row_example
+        store_split = store_split or STORE_SPLIT_NAMES.get(split, split)
+        # util/dataset/XNLI/all.py only reads these, anything else would be silently ignored
+        if store_split not in SPLITS:
+            raise ValueError("Store split must be one of {}, got {!r}".format(", ".join(SPLITS), store_split))
+    outputs = {}
+    stores = {}
+    counts = {}
+    with open(input_file, encoding="utf-8", newline="") as fin:
+        header = fin.readline()
+        columns = header.rstrip("\r\n").split("\t")
+        lang_col = columns.index("language")
+        try:
+            for lines in read_chunks(fin):
+                for line in lines:
+                    fields = line.rstrip("\r\n").split("\t")
+                    if len(fields) <= lang_col:
+                        continue
+                    lang = fields[lang_col]
+                    if languages is not None and lang not in languages:
+                        continue
+                    if lang not in outputs:
+                        outputs[lang] = open(output_path(output_dir, lang, split), "w", encoding="utf-8", newline="")
+                        outputs[lang].write(header)
+                        counts[lang] = 0
+                        if store_root is not None:
+                            stores[lang] = StoreWriter(store_dir(store_root, lang, store_split))
+                    outputs[lang].write(line)
+                    counts[lang] += 1
+                    if store_root is not None:
+                        stores[lang].add(row_example(dict(zip(columns, fields))))
+        finally:
+            for out in outputs.values():
+                out.close()
+            for store in stores.values():
+                store.close()
+    for lang, count in sorted(counts.items()):
+        print(f"Extracted {count} {LANGUAGE_NAMES.get(lang, lang).capitalize()} sentences and saved to {output_path(output_dir, lang, split)}")
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="split an XNLI TSV into one file per language in a single pass")
+    parser.add_argument("--input_file", default=os.path.join(BASE_DIR, "XNLI", "xnli.dev.tsv"))
+    parser.add_argument("--output_dir", default=os.path.join(BASE_DIR, "XNLI"))
+    parser.add_argument("--split", help="split name used in output file names, defaults to the input suffix (dev/test)")
+    parser.add_argument("--languages", nargs="+", help="language codes to keep, defaults to all")
+    parser.add_argument("--store", help="also write the columnar store under this root, e.g. dataset/XNLI/store")
+    parser.add_argument("--store_split", help="store split name, defaults to the file split (dev -> validation)")
+    args = parser.parse_args()
+    split = args.split or os.path.basename(args.input_file).split(".")[-2]
+    partition_xnli(args.input_file, args.output_dir, split, args.languages, args.store, args.store_split)
@@ -5,6 +5,8 @@ import random
 import pprint
 #2
 import model.XNLI.base
+import model.XNLI.multi_eval
+import util.dataset.XNLI.all
 import util.tool
 import os
 
@@ -75,16 +77,15 @@ class Model(model.XNLI.base.Model):
     def run_eval(self, train, dev, test):
         logging.info("Starting evaluation")
         self.eval()
-        summary = {}
 
-        datasets = {"train": train, "dev": dev}
-        datasets.update(test)
+        datasets = {"train": train, "dev": dev, "test": test}
+        if self.args.eval.languages:
+            # every requested XNLI test language goes through the same single pass
+            languages = str(self.args.eval.languages).split(" ")
+            sets = util.dataset.XNLI.all.DatasetTool.get_eval_sets(self.args, languages)
+            datasets.update({f"test_{lang}": dataset for lang, dataset in sets.items()})
 
-        for set_name, dataset in datasets.items():
-            logging.info(f"Evaluating on {set_name} dataset...")
-            _, predictions = self.run_test(dataset)
-            eval_results = self.DatasetTool.evaluate(predictions, dataset, self.args)
-            summary.update({f"eval_{set_name}_{k}": v for k, v in eval_results.items()})
+        summary = model.XNLI.multi_eval.evaluate(self, datasets, self.args.train.batch, self.args.eval.workers or 1, self.args.eval.threads)
 
         logging.info("Evaluation Results:")
         logging.info(pprint.pformat(summary))
@@ -159,29 +160,26 @@ class Model(model.XNLI.base.Model):
     def cross(self, x, disable=False):
         if not disable and self.training and (self.args.train.cross >= random.random()):
             lan = random.randint(0,len(self.args.dict_list) - 1)
-            if x in self.worddict.src2tgt[lan]:
-                return self.worddict.src2tgt[lan][x][random.randint(0,len(self.worddict.src2tgt[lan][x]) - 1)]
+            # one lookup: each probe of a compiled dictionary is a bisect over the mmap
+            cands = self.worddict.src2tgt[lan].get(x)
+            if cands:
+                return cands[random.randint(0,len(cands) - 1)]
             else:
                 return x
         else:
             return x
 
-    def cross_list(self, x):
-        return {
-        "premise": [self.cross(word, not (self.training and self.args.train.ratio >= random.random())) 
-                    for word in x["premise"]],
-        "hypothesis": [self.cross(word, not (self.training and self.args.train.ratio >= random.random())) 
-                       for word in x["hypothesis"]]
-        }
+    def cross_list(self, premise, hypothesis):
+        return ([self.cross(word, not (self.training and self.args.train.ratio >= random.random())) 
+                 for word in premise],
+                [self.cross(word, not (self.training and self.args.train.ratio >= random.random())) 
+                 for word in hypothesis])
 
-    def get_info(self, batch):
+    def get_info(self, pairs):
         token_ids = []
         token_loc = []
         
-        for x in batch:
-            premise = x["premise"]
-            hypothesis = x["hypothesis"]
-            
+        for premise, hypothesis in pairs:
             per_token_ids = [self.cls]  # CLS token at the beginning
             per_token_loc = []
             cur_idx = 1 
@@ -224,7 +222,7 @@ class Model(model.XNLI.base.Model):
         return token_loc, token_ids, type_ids, mask_ids
 
     def forward(self, batch):
-        token_loc, input_ids, type_ids, attention_mask = self.get_info(batch)
+        token_loc, input_ids, type_ids, attention_mask = self.get_info(zip(batch.premise, batch.hypothesis))
 
         outputs = self.bert(input_ids, token_type_ids=type_ids, attention_mask=attention_mask)
         pooled_output = outputs[1] if isinstance(outputs, tuple) else outputs.pooler_output
@@ -233,7 +231,7 @@ class Model(model.XNLI.base.Model):
 
         loss = torch.tensor(0.0)
         if self.training:
-            labels = torch.tensor([x["label"] for x in batch], dtype=torch.long).to(self.device)
+            labels = torch.from_numpy(batch.label.astype(np.int64)).to(self.device)
             loss = F.cross_entropy(logits, labels)
 
         predictions = torch.argmax(logits, dim=1).tolist()
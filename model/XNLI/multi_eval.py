@@ -0,0 +1,90 @@
+import logging
+import multiprocessing
+import os
+import time
+
+import numpy as np
+import torch
+
+from tqdm import tqdm
+
+from util.tool import Batch
+from util.dataset.XNLI.examples import Examples
+
+# Single-pass evaluation over many XNLI sets (e.g. all 15 test languages).
+# The model is loaded once, every set is merged into one length-sorted queue
+# and batched, and predictions are scattered back per set. On CPU the batches
+# can be sharded over forked workers that share the model's memory, each with
+# its own torch thread budget and, where supported, pinned to its own cores.
+
+_WORKER = {}
+
+
+def _init_worker(model, batches, threads, cores):
+    torch.set_num_threads(threads)
+    if cores and hasattr(os, "sched_setaffinity"):
+        identity = multiprocessing.current_process()._identity
+        slot = (identity[0] - 1) if identity else 0
+        os.sched_setaffinity(0, cores[slot % len(cores)])
+    # inherited through fork, only batch ids cross the process boundary
+    _WORKER["model"] = model
+    _WORKER["batches"] = batches
+
+
+def _run_shard(batch_ids):
+    model = _WORKER["model"]
+    out = []
+    with torch.no_grad():
+        for batch_id in batch_ids:
+            _, pred = model.forward(_WORKER["batches"][batch_id])
+            out.append((batch_id, pred))
+    return out
+
+
+def core_slices(workers, threads):
+    if not hasattr(os, "sched_getaffinity"):
+        return None
+    cores = sorted(os.sched_getaffinity(0))
+    if len(cores) < workers * threads:
+        return None
+    return [set(cores[i * threads : (i + 1) * threads]) for i in range(workers)]
+
+
+def predict(model, dataset, batch_size, workers=1, threads=None):
+    order = np.argsort(dataset.lengths(), kind="stable")
+    batches = Batch.to_list(dataset[order], batch_size)
+    sorted_pred = [None] * len(batches)
+    if workers <= 1:
+        with torch.no_grad():
+            for batch_id, batch in enumerate(tqdm(batches)):
+                _, sorted_pred[batch_id] = model.forward(batch)
+    else:
+        threads = threads or max(1, (os.cpu_count() or 1) // workers)
+        # round-robin so every shard gets a mix of short and long batches
+        shards = [list(range(k, len(batches), workers)) for k in range(workers)]
+        context = multiprocessing.get_context("fork")
+        with context.Pool(workers, initializer=_init_worker, initargs=(model, batches, threads, core_slices(workers, threads))) as pool:
+            for shard in pool.imap_unordered(_run_shard, shards):
+                for batch_id, pred in shard:
+                    sorted_pred[batch_id] = pred
+    pred = np.empty(len(dataset), dtype=np.int64)
+    pred[order] = np.concatenate([np.asarray(p, dtype=np.int64) for p in sorted_pred]) if batches else pred[:0]
+    return pred
+
+
+def evaluate(model, sets, batch_size, workers=1, threads=None):
+    model.eval()
+    names = list(sets)
+    if model.args.train.gpu:
+        workers = 1
+    start = time.time()
+    merged = Examples.concat([sets[name] for name in names])
+    pred = predict(model, merged, batch_size, workers, threads)
+    logging.info("Evaluated {} examples from {} sets in {:.1f}s".format(len(merged), len(names), time.time() - start))
+    summary = {}
+    bounds = np.cumsum([0] + [len(sets[name]) for name in names])
+    for name, bgn, end in zip(names, bounds[:-1], bounds[1:]):
+        logging.info(f"Evaluating on {name} dataset...")
+        results = model.DatasetTool.evaluate(pred[bgn:end].tolist(), sets[name], model.args)
+        summary.update({f"eval_{name}_{k}": v for k, v in results.items()})
+    return summary
@@ -0,0 +1,219 @@
+import argparse
+import json
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+
+import numpy as np
+
+# Binary store for UD annotations (sentence, POS tags, DEP tags), the records
+# written as "sentence<TAB>POS POS ...<TAB>DEP DEP ..." by the annotators in
+# data_augment/model. Tags are kept as uint8 ids against an embedded label
+# vocabulary and sentences as one UTF-8 blob, so record i is read in O(1)
+# through the offset arrays without re-splitting any strings. The file is
+# opened with a read-only mmap.
+#
+# Layout (integers little-endian, every section padded to 8 bytes):
+#   header    MAGIC, n_sentences, n_pos_labels, n_dep_labels, vocab_len, n_pos, n_dep, blob_len
+#   vocab     JSON {"pos": [...], "dep": [...]}, ids index these lists
+#   sent_off  uint64 [n_sentences + 1] byte offsets into the sentence blob
+#   pos_off   uint64 [n_sentences + 1] offsets into pos_ids
+#   dep_off   uint64 [n_sentences + 1] offsets into dep_ids
+#   pos_ids   uint8 [n_pos]
+#   dep_ids   uint8 [n_dep]
+#   blob      UTF-8 sentences
+
+MAGIC = b"CSANNO01"
+HEADER = struct.Struct("<8s7Q")
+SUFFIX = ".anno"
+MAX_LABELS = 256
+
+
+def pad8(n):
+    return -n % 8
+
+
+def split_tags(field):
+    return field.split(" ") if field else []
+
+
+def parse_tsv_line(line):
+    sentence, pos, dep = line.rstrip("\n").split("\t")
+    return sentence, split_tags(pos), split_tags(dep)
+
+
+def read_tsv(file):
+    with open(file, encoding="utf8") as reader:
+        for line in reader:
+            # blank lines (e.g. a trailing empty line) are not records
+            if line.strip():
+                yield parse_tsv_line(line)
+
+
+def format_tsv_line(sentence, pos_tags, dep_tags):
+    return sentence + "\t" + " ".join(pos_tags) + "\t" + " ".join(dep_tags) + "\n"
+
+
+def is_store(file):
+    with open(file, "rb") as reader:
+        return reader.read(len(MAGIC)) == MAGIC
+
+
+class AnnotationWriter(object):
+    def __init__(self, file, pos_labels=None, dep_labels=None):
+        self.file = file
+        self.pos_vocab = {label: i for i, label in enumerate(pos_labels or [])}
+        self.dep_vocab = {label: i for i, label in enumerate(dep_labels or [])}
+        self.sent_off = [0]
+        self.pos_off = [0]
+        self.dep_off = [0]
+        self.pos_ids = bytearray()
+        self.dep_ids = bytearray()
+        # sentences are spilled to a temp file, only the tag ids stay in memory
+        fd, self.blob_path = tempfile.mkstemp(suffix=".blob", dir=os.path.dirname(os.path.abspath(file)))
+        self.blob = os.fdopen(fd, "wb")
+
+    def __len__(self):
+        return len(self.sent_off) - 1
+
+    def label_ids(self, vocab, tags):
+        for tag in tags:
+            if tag not in vocab:
+                if len(vocab) == MAX_LABELS:
+                    raise ValueError("Annotation store holds at most {} labels per tag set".format(MAX_LABELS))
+                vocab[tag] = len(vocab)
+        return bytes(vocab[tag] for tag in tags)
+
+    def add(self, sentence, pos_tags, dep_tags):
+        data = sentence.encode("utf8")
+        self.blob.write(data)
+        self.sent_off.append(self.sent_off[-1] + len(data))
+        self.pos_ids += self.label_ids(self.pos_vocab, pos_tags)
+        self.dep_ids += self.label_ids(self.dep_vocab, dep_tags)
+        self.pos_off.append(len(self.pos_ids))
+        self.dep_off.append(len(self.dep_ids))
+
+    def close(self):
+        self.blob.close()
+        vocab = json.dumps({"pos": list(self.pos_vocab), "dep": list(self.dep_vocab)}, ensure_ascii=False).encode("utf8")
+        header = HEADER.pack(MAGIC, len(self), len(self.pos_vocab), len(self.dep_vocab), len(vocab),
+                             len(self.pos_ids), len(self.dep_ids), self.sent_off[-1])
+        tmp = self.file + ".tmp"
+        with open(tmp, "wb") as writer:
+            writer.write(header)
+            for section in (vocab, np.asarray(self.sent_off, dtype="<u8").tobytes(),
+                            np.asarray(self.pos_off, dtype="<u8").tobytes(), np.asarray(self.dep_off, dtype="<u8").tobytes(),
+                            bytes(self.pos_ids), bytes(self.dep_ids)):
+                writer.write(section)
+                writer.write(b"\0" * pad8(len(section)))
+            with open(self.blob_path, "rb") as blob:
+                shutil.copyfileobj(blob, writer)
+        os.remove(self.blob_path)
+        os.replace(tmp, self.file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.blob.close()
+            os.remove(self.blob_path)
+
+
+class AnnotationStore(object):
+    def __init__(self, file):
+        self.file = file
+        with open(file, "rb") as reader:
+            self.mm = mmap.mmap(reader.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, n_sentences, n_pos_labels, n_dep_labels, vocab_len, n_pos, n_dep, blob_len = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise ValueError("Not an annotation store: {}".format(file))
+        pos = HEADER.size
+
+        def take(nbytes, dtype):
+            nonlocal pos
+            out = np.frombuffer(self.mm, dtype=dtype, count=nbytes // np.dtype(dtype).itemsize, offset=pos)
+            pos += nbytes + pad8(nbytes)
+            return out
+
+        vocab = json.loads(bytes(take(vocab_len, np.uint8)).decode("utf8"))
+        self.pos_labels = vocab["pos"]
+        self.dep_labels = vocab["dep"]
+        self.sent_off = take(8 * (n_sentences + 1), "<u8")
+        self.pos_off = take(8 * (n_sentences + 1), "<u8")
+        self.dep_off = take(8 * (n_sentences + 1), "<u8")
+        self.pos_ids = take(n_pos, np.uint8)
+        self.dep_ids = take(n_dep, np.uint8)
+        self.blob = take(blob_len, np.uint8)
+
+    def __getstate__(self):
+        # workers reopen the mmap instead of pickling the arrays
+        return {"file": self.file}
+
+    def __setstate__(self, state):
+        self.__init__(state["file"])
+
+    def __len__(self):
+        return len(self.sent_off) - 1
+
+    def sentence(self, idx):
+        return self.blob[self.sent_off[idx] : self.sent_off[idx + 1]].tobytes().decode("utf8")
+
+    def pos(self, idx):
+        return self.pos_ids[self.pos_off[idx] : self.pos_off[idx + 1]]
+
+    def dep(self, idx):
+        return self.dep_ids[self.dep_off[idx] : self.dep_off[idx + 1]]
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(idx)
+        return (self.sentence(idx),
+                [self.pos_labels[i] for i in self.pos(idx).tolist()],
+                [self.dep_labels[i] for i in self.dep(idx).tolist()])
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+
+def read_annotations(file):
+    """Yield (sentence, pos_tags, dep_tags) from either an annotation store or the annotators' TSV output."""
+    if is_store(file):
+        yield from AnnotationStore(file)
+        return
+    yield from read_tsv(file)
+
+
+def tsv_to_store(files, output):
+    with AnnotationWriter(output) as writer:
+        for file in ([files] if isinstance(files, str) else files):
+            for record in read_tsv(file):
+                writer.add(*record)
+    return output
+
+
+def store_to_tsv(file, output):
+    with open(output, "w", encoding="utf8") as writer:
+        for record in AnnotationStore(file):
+            writer.write(format_tsv_line(*record))
+    return output
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="convert annotation TSVs to and from the binary store")
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("--to_tsv", action="store_true", help="convert stores back to TSV")
+    args = parser.parse_args()
+    for file in args.files:
+        if args.to_tsv:
+            output = store_to_tsv(file, os.path.splitext(file)[0] + ".txt")
+        else:
+            output = tsv_to_store(file, os.path.splitext(file)[0] + SUFFIX)
+        print("Converted {} -> {}".format(file, output))
@@ -0,0 +1,72 @@
+import random
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+# DataLoader pieces shared by the data_augment trainers: a worker init that
+# seeds every RNG and caps torch threads per worker, and a length-bucketed
+# batch sampler for datasets that expose lengths() (token counts per example),
+# which also shards its batches across DDP ranks.
+
+
+def seed_worker(worker_id, threads=1):
+    # torch already gives each worker base_seed + worker_id; derive the others from it
+    seed = torch.initial_seed() % 2**32
+    np.random.seed(seed)
+    random.seed(seed)
+    torch.set_num_threads(threads)
+
+
+class LengthBucketSampler(Sampler):
+    """Shuffled batches of similar-length examples, so dynamic padding trims most of each batch.
+
+    Examples are shuffled, cut into buckets of batch_size * bucket_batches, sorted by length
+    inside each bucket and split into batches; the batch order is shuffled again. With
+    num_replicas > 1 every rank builds the same list from the shared seed and takes every
+    num_replicas-th batch, wrapping around so all ranks run the same number of steps.
+    """
+
+    def __init__(self, lengths, batch_size, bucket_batches=50, shuffle=True, drop_last=False, seed=0,
+                 num_replicas=1, rank=0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_size = batch_size * bucket_batches
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def batches(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        order = rng.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        batches = []
+        for bgn in range(0, len(order), self.bucket_size):
+            bucket = order[bgn : bgn + self.bucket_size]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind="stable")]
+            for i in range(0, len(bucket), self.batch_size):
+                batch = bucket[i : i + self.batch_size]
+                if len(batch) == self.batch_size or not self.drop_last:
+                    batches.append(batch.tolist())
+        if self.shuffle:
+            rng.shuffle(batches)
+        if self.num_replicas > 1:
+            while batches and len(batches) < len(self) * self.num_replicas:
+                batches += batches[: len(self) * self.num_replicas - len(batches)]
+            batches = batches[self.rank :: self.num_replicas]
+        return batches
+
+    def __iter__(self):
+        return iter(self.batches())
+
+    def __len__(self):
+        if self.drop_last:
+            n_batches = len(self.lengths) // self.batch_size
+        else:
+            n_batches = (len(self.lengths) + self.batch_size - 1) // self.batch_size
+        return (n_batches + self.num_replicas - 1) // self.num_replicas
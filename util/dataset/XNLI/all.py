@@ -1,55 +1,44 @@
 import os
-import random
+
+import numpy as np
 
 import util.data
 import util.convert
+import util.dictionary
 import util.tool
+import util.dataset.XNLI.store
+from util.dataset.XNLI.examples import Examples
 from datasets import load_dataset, Dataset
 
 class DatasetTool(object):
     def get_set(file):
-        dataset = []
         label_map = {"entailment": 0, "neutral": 1, "contradiction": 2}
 
         # modified to handle huggingface xnli datasets
-        for example in file:
-            label = example["label"]
-            if isinstance(label, str) and label not in label_map:
-                continue 
-
-            dataset.append({
-                "premise": example["premise"],
-                "hypothesis": example["hypothesis"],
-                "label": label_map.get(label, label)
-            })
-
-        return dataset
+        return Examples.from_dicts(file, label_map)
 
     def get_idx_dict(idx_dict, file, args):
-        raw = util.data.Delexicalizer.remove_linefeed(util.data.Reader.read_raw(file))
-        if args.train.dict_size is not None:
-            raw = raw[:int(len(raw) * args.train.dict_size)]
-        idx_dict.src2tgt.append({})
-        for line in raw:
-            try:
-                src, tgt = line.split("\t")
-            except:
-                src, tgt = line.split(" ")
-            
-            if src not in idx_dict.src2tgt[-1]:
-                idx_dict.src2tgt[-1][src] = [tgt]
-            else:
-                idx_dict.src2tgt[-1][src].append(tgt)
+        # compiled once next to the text file and shared read-only via mmap
+        idx_dict.src2tgt.append(util.dictionary.load(file, size=args.train.dict_size))
 
     def get(args):
-        train_file = load_dataset("facebook/xnli", "en", split="train")
-        dev_file = load_dataset("facebook/xnli", "en", split="validation")
-        test_file = load_dataset("facebook/xnli", "hi", split="test")
+        store = os.path.join(args.dir.dataset, args.dataset.store) if args.dataset.store else None
+        if store is not None and all(util.dataset.XNLI.store.exists(store, lang, split) for lang, split in [("en", "train"), ("en", "validation"), ("hi", "test")]):
+            # seeded sampling happens at load time, only train_size of the split is read
+            train = util.dataset.XNLI.store.load(store, "en", "train", args.train.train_size, args.train.seed)
+            dev = util.dataset.XNLI.store.load(store, "en", "validation")
+            test = util.dataset.XNLI.store.load(store, "hi", "test")
+        else:
+            train_file = load_dataset("facebook/xnli", "en", split="train")
+            dev_file = load_dataset("facebook/xnli", "en", split="validation")
+            test_file = load_dataset("facebook/xnli", "hi", split="test")
 
-        train = DatasetTool.get_set(train_file)
-        random.shuffle(train)
-        dev = DatasetTool.get_set(dev_file)
-        test = DatasetTool.get_set(test_file)
+            train = DatasetTool.get_set(train_file)
+            train = train.shuffle()
+            dev = DatasetTool.get_set(dev_file)
+            test = DatasetTool.get_set(test_file)
+            if args.train.train_size is not None:
+                train = train[:int(len(train) * args.train.train_size)]
 
         # passing the dictionary as an arg
         args.dict_list = args.dataset.dict.split(" ")
@@ -57,13 +46,23 @@ class DatasetTool(object):
         for dict_file in args.dict_list:
             dict_file = os.path.join(args.dir.dataset, dict_file)
             DatasetTool.get_idx_dict(idx_dict, dict_file, args)
-        if args.train.train_size is not None:
-            train = train[:int(len(train) * args.train.train_size)]
         return train, dev, test, None, idx_dict, None
 
+    def get_eval_sets(args, languages, split="test"):
+        if languages == ["all"]:
+            languages = util.dataset.XNLI.store.LANGUAGES
+        store = os.path.join(args.dir.dataset, args.dataset.store) if args.dataset.store else None
+        sets = {}
+        for lang in languages:
+            if store is not None and util.dataset.XNLI.store.exists(store, lang, split):
+                sets[lang] = util.dataset.XNLI.store.load(store, lang, split)
+            else:
+                sets[lang] = DatasetTool.get_set(load_dataset("facebook/xnli", lang, split=split))
+        return sets
+
     def evaluate(pred, dataset, args):
         total = len(dataset)
-        correct = sum(1 for p, g in zip(pred, dataset) if p == g["label"])
+        correct = int((np.asarray(pred, dtype=np.int64) == dataset.label[:len(pred)]).sum())
         accuracy = correct / total if total > 0 else 0.0
 
         print(f"XNLI Evaluation Accuracy: {accuracy * 100:.2f}%")
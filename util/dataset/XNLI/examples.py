@@ -0,0 +1,124 @@
+import array
+
+import numpy as np
+
+# Struct-of-arrays container for XNLI examples. Premises repeat roughly three
+# times in XNLI, so both text columns are kept as deduplicated UTF-8 string
+# tables referenced by int32 index arrays, with labels in a uint8 array.
+# Slicing returns a view that shares the tables, which is what Batch.to_list,
+# run_train, run_test and DatasetTool.evaluate consume; the whole container
+# pickles as a handful of flat buffers.
+
+
+class StringTable(object):
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        return bytes(self.blob[self.offsets[idx] : self.offsets[idx + 1]]).decode("utf8")
+
+    def take(self, indices):
+        return [self[i] for i in indices]
+
+    def from_strings(strings):
+        offsets = array.array("q", [0])
+        chunks = []
+        for s in strings:
+            data = s.encode("utf8")
+            chunks.append(data)
+            offsets.append(offsets[-1] + len(data))
+        blob = np.frombuffer(b"".join(chunks), dtype=np.uint8)
+        return StringTable(blob, np.frombuffer(offsets, dtype=np.int64))
+
+    def concat(tables):
+        blobs = [np.asarray(t.blob[: t.offsets[-1]]) for t in tables]
+        bases = np.cumsum([0] + [len(b) for b in blobs])
+        offsets = [np.asarray(t.offsets[:-1]) + base for t, base in zip(tables, bases)] + [np.array([bases[-1]])]
+        return StringTable(np.concatenate(blobs), np.concatenate(offsets).astype(np.int64))
+
+
+class ExamplesBuilder(object):
+    def __init__(self):
+        self.premise_ids = {}
+        self.hypothesis_ids = {}
+        self.premise_idx = array.array("i")
+        self.hypothesis_idx = array.array("i")
+        self.label = array.array("B")
+
+    def __len__(self):
+        return len(self.label)
+
+    def add(self, premise, hypothesis, label):
+        self.premise_idx.append(self.premise_ids.setdefault(premise, len(self.premise_ids)))
+        self.hypothesis_idx.append(self.hypothesis_ids.setdefault(hypothesis, len(self.hypothesis_ids)))
+        self.label.append(label)
+
+    def build(self):
+        return Examples(
+            StringTable.from_strings(self.premise_ids),
+            np.frombuffer(self.premise_idx, dtype=np.int32),
+            StringTable.from_strings(self.hypothesis_ids),
+            np.frombuffer(self.hypothesis_idx, dtype=np.int32),
+            np.frombuffer(self.label, dtype=np.uint8))
+
+
+class Examples(object):
+    def __init__(self, premises, premise_idx, hypotheses, hypothesis_idx, label):
+        self.premises = premises
+        self.premise_idx = premise_idx
+        self.hypotheses = hypotheses
+        self.hypothesis_idx = hypothesis_idx
+        self.label = label
+
+    def from_dicts(examples, label_map=None):
+        builder = ExamplesBuilder()
+        for ex in examples:
+            label = ex["label"]
+            if label_map is not None:
+                if isinstance(label, str) and label not in label_map:
+                    continue
+                label = label_map.get(label, label)
+            builder.add(ex["premise"], ex["hypothesis"], label)
+        return builder.build()
+
+    def concat(parts):
+        def merge(tables, indices):
+            bases = np.cumsum([0] + [len(t) for t in tables])[:-1]
+            return StringTable.concat(tables), np.concatenate([idx + base for idx, base in zip(indices, bases)]).astype(np.int32)
+        premises, premise_idx = merge([p.premises for p in parts], [p.premise_idx for p in parts])
+        hypotheses, hypothesis_idx = merge([p.hypotheses for p in parts], [p.hypothesis_idx for p in parts])
+        return Examples(premises, premise_idx, hypotheses, hypothesis_idx, np.concatenate([p.label for p in parts]))
+
+    def __len__(self):
+        return len(self.label)
+
+    def lengths(self):
+        # UTF-8 byte length of premise + hypothesis, a cheap proxy for token count
+        premise = self.premises.offsets[self.premise_idx + 1] - self.premises.offsets[self.premise_idx]
+        hypothesis = self.hypotheses.offsets[self.hypothesis_idx + 1] - self.hypotheses.offsets[self.hypothesis_idx]
+        return premise + hypothesis
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return self.premises[self.premise_idx[key]], self.hypotheses[self.hypothesis_idx[key]], int(self.label[key])
+        # slices are numpy views, index arrays gather; the string tables are shared
+        return Examples(self.premises, self.premise_idx[key], self.hypotheses, self.hypothesis_idx[key], self.label[key])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    @property
+    def premise(self):
+        return self.premises.take(self.premise_idx)
+
+    @property
+    def hypothesis(self):
+        return self.hypotheses.take(self.hypothesis_idx)
+
+    def shuffle(self, rng=np.random):
+        return self[rng.permutation(len(self))]
@@ -0,0 +1,105 @@
+import hashlib
+import itertools
+import logging
+import os
+
+import numpy as np
+
+from util.dataset.XNLI.examples import ExamplesBuilder
+
+# On-disk (premise, hypothesis) -> label index for the English XNLI train split.
+# Each pair is hashed to a uint64, stored sorted next to its uint8 label and
+# loaded with mmap_mode="r", so the ~392k-pair split is never reloaded from
+# the hub (or materialized as a Python dict) just to recover labels.
+
+LABEL_MAP = {"entailment": 0, "neutral": 1, "contradiction": 2}
+DTYPE = np.dtype([("hash", "<u8"), ("label", "u1")])
+
+
+def normalize(text):
+    return " ".join(text.split())
+
+
+def pair_hash(premise, hypothesis):
+    key = (normalize(premise) + "\t" + normalize(hypothesis)).encode("utf8")
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little")
+
+
+class LabelIndex(object):
+    def __init__(self, file):
+        self.file = file
+        self.table = np.load(file, mmap_mode="r")
+
+    def __len__(self):
+        return len(self.table)
+
+    def build(examples, file):
+        hashes = []
+        labels = []
+        for ex in examples:
+            label = LABEL_MAP.get(ex["label"], ex["label"])
+            if isinstance(label, str) or label < 0:
+                continue
+            hashes.append(pair_hash(ex["premise"], ex["hypothesis"]))
+            labels.append(label)
+        table = np.empty(len(hashes), dtype=DTYPE)
+        table["hash"] = np.array(hashes, dtype=np.uint64)
+        table["label"] = np.array(labels, dtype=np.uint8)
+        # stable sort, then keep the last label of a repeated pair like dict assignment did
+        table = table[np.argsort(table["hash"], kind="stable")]
+        keep = np.append(table["hash"][1:] != table["hash"][:-1], True) if len(table) else np.ones(0, dtype=bool)
+        table = table[keep]
+        os.makedirs(os.path.dirname(os.path.abspath(file)), exist_ok=True)
+        tmp = file + ".tmp.npy"
+        np.save(tmp, table)
+        os.replace(tmp, file)
+        logging.info("Built XNLI label index with {} pairs at {}".format(len(table), file))
+
+    def load(file, examples=None):
+        if not os.path.exists(file):
+            if examples is None:
+                from datasets import load_dataset
+                examples = load_dataset("facebook/xnli", "en", split="train")
+            LabelIndex.build(examples, file)
+        return LabelIndex(file)
+
+    def lookup(self, hashes):
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        pos = np.searchsorted(self.table["hash"], hashes)
+        pos = np.minimum(pos, max(len(self.table) - 1, 0))
+        labels = np.full(len(hashes), -1, dtype=np.int16)
+        if len(self.table):
+            hit = self.table["hash"][pos] == hashes
+            labels[hit] = self.table["label"][pos[hit]]
+        return labels
+
+    def join(self, code_switched_file, original_file, chunk_size=4096):
+        # Streams both files in lockstep; returns the labelled code-switched pairs
+        # and the (pair number, original pair) entries that had no label.
+        builder = ExamplesBuilder()
+        unmatched = []
+        pairs = itertools.zip_longest(read_pairs(code_switched_file), read_pairs(original_file))
+        for chunk_start in itertools.count(0, chunk_size):
+            chunk = list(itertools.islice(pairs, chunk_size))
+            if not chunk:
+                break
+            hashes = [pair_hash(*orig) if orig is not None and orig[1] is not None else 0 for _, orig in chunk]
+            labels = self.lookup(hashes)
+            for offset, ((cs, orig), label) in enumerate(zip(chunk, labels)):
+                if cs is None or orig is None or cs[1] is None or orig[1] is None or label < 0:
+                    unmatched.append((chunk_start + offset, orig))
+                    continue
+                builder.add(cs[0], cs[1], int(label))
+        if unmatched:
+            logging.warning("{} of {} pairs in {} could not be labelled, e.g. {}".format(
+                len(unmatched), len(builder) + len(unmatched), original_file, unmatched[:3]))
+        return builder.build(), unmatched
+
+
+def read_pairs(file):
+    with open(file, encoding="utf-8") as reader:
+        lines = (line.strip() for line in reader)
+        lines = (line for line in lines if line)
+        for first, second in itertools.zip_longest(lines, lines):
+            yield first, second
+
@@ -0,0 +1,150 @@
+import argparse
+import array
+import csv
+import logging
+import os
+import sys
+
+import numpy as np
+
+from util.dataset.XNLI.examples import ExamplesBuilder
+from util.dataset.XNLI.label_index import LABEL_MAP
+
+# Local columnar XNLI store, one directory per language and split:
+#   {premise,hypothesis}.bin       UTF-8 string blobs
+#   {premise,hypothesis}.off.npy   int64 offsets [n + 1] into the blobs
+#   label.npy                      uint8 labels [n]
+# Everything is opened with mmap, so a sampled load only touches the pages of
+# the rows it keeps and the store works without network access once built.
+
+LANGUAGES = ["ar", "bg", "de", "el", "en", "es", "fr", "hi", "ru", "sw", "th", "tr", "ur", "vi", "zh"]
+SPLITS = ["train", "validation", "test"]
+COLUMNS = ["premise", "hypothesis"]
+
+
+def store_dir(root, lang, split):
+    return os.path.join(root, lang, split)
+
+
+def row_example(row):
+    return {"premise": row["sentence1"], "hypothesis": row["sentence2"], "label": row["gold_label"]}
+
+
+def exists(root, lang, split):
+    return os.path.exists(os.path.join(store_dir(root, lang, split), "label.npy"))
+
+
+class StoreWriter(object):
+    # incremental writer, so one pass over a multi-language TSV can fill many stores
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.offsets = {column: array.array("q", [0]) for column in COLUMNS}
+        self.labels = array.array("B")
+        self.writers = {column: open(os.path.join(directory, column + ".bin"), "wb") for column in COLUMNS}
+
+    def add(self, ex):
+        label = LABEL_MAP.get(ex["label"], ex["label"])
+        if isinstance(label, str) or label < 0:
+            return
+        for column in COLUMNS:
+            data = ex[column].encode("utf8")
+            self.writers[column].write(data)
+            self.offsets[column].append(self.offsets[column][-1] + len(data))
+        self.labels.append(label)
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+        for column in COLUMNS:
+            np.save(os.path.join(self.directory, column + ".off.npy"), np.frombuffer(self.offsets[column], dtype=np.int64))
+        # label.npy is written last and marks the directory as complete
+        np.save(os.path.join(self.directory, "label.npy"), np.frombuffer(self.labels, dtype=np.uint8))
+        logging.info("Stored {} XNLI examples in {}".format(len(self.labels), self.directory))
+        return len(self.labels)
+
+
+class XNLIStore(object):
+    def __init__(self, directory):
+        self.directory = directory
+        self.label = np.load(os.path.join(directory, "label.npy"), mmap_mode="r")
+        self.offsets = {}
+        self.blobs = {}
+        for column in COLUMNS:
+            self.offsets[column] = np.load(os.path.join(directory, column + ".off.npy"), mmap_mode="r")
+            self.blobs[column] = np.memmap(os.path.join(directory, column + ".bin"), dtype=np.uint8, mode="r") \
+                if self.offsets[column][-1] > 0 else np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.label)
+
+    def build(examples, directory):
+        writer = StoreWriter(directory)
+        for ex in examples:
+            writer.add(ex)
+        return writer.close()
+
+    def build_from_hub(root, languages=LANGUAGES, splits=SPLITS):
+        # reads the local HF cache when HF_DATASETS_OFFLINE=1
+        from datasets import load_dataset
+        for lang in languages:
+            for split in splits:
+                XNLIStore.build(load_dataset("facebook/xnli", lang, split=split), store_dir(root, lang, split))
+
+    def build_from_tsv(file, root, split, languages=None):
+        # XNLI release TSVs carry every language in one file; see dataset/filter_xnli.py
+        writers = {}
+        with open(file, encoding="utf-8", newline="") as reader:
+            for row in csv.DictReader(reader, delimiter="\t", quoting=csv.QUOTE_NONE):
+                lang = row["language"]
+                if languages is not None and lang not in languages:
+                    continue
+                if lang not in writers:
+                    writers[lang] = StoreWriter(store_dir(root, lang, split))
+                writers[lang].add(row_example(row))
+        for writer in writers.values():
+            writer.close()
+
+    def sample(self, fraction=None, seed=None):
+        # seeded random order; replaces shuffle-then-slice over the full split
+        total = len(self)
+        size = total if fraction is None else int(total * fraction)
+        rng = np.random.default_rng(seed)
+        return rng.choice(total, size=size, replace=False)
+
+    def text(self, column, indices):
+        offsets, blob = self.offsets[column], self.blobs[column]
+        starts = offsets[indices]
+        ends = offsets[np.asarray(indices) + 1]
+        return [bytes(blob[s : e]).decode("utf8") for s, e in zip(starts, ends)]
+
+    def examples(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        builder = ExamplesBuilder()
+        for premise, hypothesis, label in zip(self.text("premise", indices), self.text("hypothesis", indices), self.label[indices].tolist()):
+            builder.add(premise, hypothesis, label)
+        return builder.build()
+
+
+def load(root, lang, split, fraction=None, seed=None):
+    store = XNLIStore(store_dir(root, lang, split))
+    if fraction is None and seed is None:
+        return store.examples(np.arange(len(store)))
+    return store.examples(store.sample(fraction, seed))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="build the local columnar XNLI store")
+    parser.add_argument("--root", default=os.path.join("dataset", "XNLI", "store"))
+    parser.add_argument("--languages", nargs="+", default=LANGUAGES)
+    parser.add_argument("--splits", nargs="+", default=SPLITS)
+    parser.add_argument("--tsv", help="build from an XNLI release TSV instead of the HF cache")
+    parser.add_argument("--split", help="split name for --tsv")
+    args = parser.parse_args()
+    if args.tsv:
+        if args.split is None:
+            sys.exit("--split is required with --tsv")
+        XNLIStore.build_from_tsv(args.tsv, args.root, args.split, args.languages)
+    else:
+        XNLIStore.build_from_hub(args.root, args.languages, args.splits)
@@ -0,0 +1,196 @@
+import argparse
+import array
+import bisect
+import mmap
+import os
+import struct
+import sys
+import tempfile
+
+# Compiled bilingual dictionary: a sorted, offset-indexed binary image of the
+# Panlex/MUSE style "src<TAB|SPACE>tgt" text dictionaries. The file is opened
+# with a read-only mmap so every DataLoader worker or sweep process shares the
+# same page cache instead of carrying its own dict-of-lists.
+#
+# Layout (all integers uint32, native little-endian):
+#   header    MAGIC, n_lines, n_strings, blob_len, n_exact, n_exact_cand, n_lower, n_lower_cand
+#   str_off   [n_strings + 1] byte offsets into the UTF-8 string blob
+#   blob      UTF-8 string table (padded to 4 bytes)
+#   exact     key ids [n_exact] sorted by bytes, cand starts [n_exact + 1],
+#             cand ids [n_exact_cand], cand source lines [n_exact_cand]
+#   lower     same four arrays for lowercased keys
+
+MAGIC = b"CSDICT01"
+HEADER = struct.Struct("<8s7I")
+SUFFIX = ".bin"
+
+
+def parse_line(line):
+    parts = line.rstrip("\n").split("\t")
+    if len(parts) != 2:
+        parts = line.split()
+    if len(parts) < 2:
+        return None
+    return parts[0], parts[1]
+
+
+class DictCompiler(object):
+    def compiled_path(file):
+        return os.path.splitext(file)[0] + SUFFIX
+
+    def is_stale(file, output=None):
+        output = output or DictCompiler.compiled_path(file)
+        return not os.path.exists(output) or os.path.getmtime(output) < os.path.getmtime(file)
+
+    def compile(file, output=None):
+        output = output or DictCompiler.compiled_path(file)
+        strings = {}
+        exact = {}
+        lower = {}
+
+        def intern(s):
+            if s not in strings:
+                strings[s] = len(strings)
+            return strings[s]
+
+        n_lines = 0
+        with open(file, encoding="utf8") as reader:
+            for line in reader:
+                pair = parse_line(line)
+                if pair is not None:
+                    src, tgt = pair
+                    tgt_id = intern(tgt)
+                    exact.setdefault(intern(src), []).append((tgt_id, n_lines))
+                    lower.setdefault(intern(src.lower()), []).append((tgt_id, n_lines))
+                n_lines += 1
+
+        encoded = [s.encode("utf8") for s in strings]
+        str_off = array.array("I", [0])
+        for s in encoded:
+            str_off.append(str_off[-1] + len(s))
+        blob = b"".join(encoded)
+        blob += b"\0" * (-len(blob) % 4)
+
+        def index(table):
+            keys = sorted(table, key=lambda k: encoded[k])
+            key_ids = array.array("I", keys)
+            starts = array.array("I", [0])
+            cands = array.array("I")
+            lines = array.array("I")
+            for key in keys:
+                for tgt_id, line_no in table[key]:
+                    cands.append(tgt_id)
+                    lines.append(line_no)
+                starts.append(len(cands))
+            return key_ids, starts, cands, lines
+
+        exact_arrays = index(exact)
+        lower_arrays = index(lower)
+        header = HEADER.pack(MAGIC, n_lines, len(encoded), len(blob),
+                             len(exact_arrays[0]), len(exact_arrays[2]),
+                             len(lower_arrays[0]), len(lower_arrays[2]))
+        # private temp file, so processes compiling the same dictionary at once never share one
+        fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(os.path.abspath(output)))
+        with os.fdopen(fd, "wb") as writer:
+            writer.write(header)
+            writer.write(str_off.tobytes())
+            writer.write(blob)
+            for arr in exact_arrays + lower_arrays:
+                writer.write(arr.tobytes())
+        # mkstemp creates 0600; give the image the usual umask permissions
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp, 0o666 & ~umask)
+        os.replace(tmp, output)
+        return output
+
+
+class CompiledDict(object):
+    def __init__(self, file, lower=False, size=None):
+        self.file = file
+        self.lower = lower
+        self.size = size
+        with open(file, "rb") as reader:
+            self.mm = mmap.mmap(reader.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, n_lines, n_strings, blob_len, n_exact, n_exact_cand, n_lower, n_lower_cand = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise ValueError("Not a compiled dictionary: {}".format(file))
+        if sys.byteorder != "little":
+            raise ValueError("Compiled dictionaries are little-endian only")
+        view = memoryview(self.mm)
+        pos = HEADER.size
+
+        def take(n):
+            nonlocal pos
+            out = view[pos : pos + 4 * n].cast("I")
+            pos += 4 * n
+            return out
+
+        self.str_off = take(n_strings + 1)
+        self.blob = view[pos : pos + blob_len]
+        pos += blob_len
+        exact = (take(n_exact), take(n_exact + 1), take(n_exact_cand), take(n_exact_cand))
+        lower_idx = (take(n_lower), take(n_lower + 1), take(n_lower_cand), take(n_lower_cand))
+        self.keys, self.starts, self.cands, self.lines = lower_idx if lower else exact
+        self.max_line = n_lines if size is None else int(n_lines * size)
+
+    def __getstate__(self):
+        # workers reopen the mmap instead of pickling the table
+        return {"file": self.file, "lower": self.lower, "size": self.size}
+
+    def __setstate__(self, state):
+        self.__init__(state["file"], state["lower"], state["size"])
+
+    def string(self, idx):
+        return bytes(self.blob[self.str_off[idx] : self.str_off[idx + 1]])
+
+    def find(self, word):
+        if self.lower:
+            word = word.lower()
+        target = word.encode("utf8")
+        pos = bisect.bisect_left(range(len(self.keys)), target, key=lambda i: self.string(self.keys[i]))
+        if pos < len(self.keys) and self.string(self.keys[pos]) == target:
+            return pos
+        return None
+
+    def candidates(self, word):
+        pos = self.find(word)
+        if pos is None:
+            return []
+        out = []
+        # candidates are kept in source line order, so dict_size is a prefix cut
+        for i in range(self.starts[pos], self.starts[pos + 1]):
+            if self.lines[i] >= self.max_line:
+                break
+            out.append(self.string(self.cands[i]).decode("utf8"))
+        return out
+
+    def get(self, word, default=None):
+        cands = self.candidates(word)
+        return cands if cands else default
+
+    def __contains__(self, word):
+        return len(self.candidates(word)) > 0
+
+    def __getitem__(self, word):
+        cands = self.candidates(word)
+        if not cands:
+            raise KeyError(word)
+        return cands
+
+
+def load(file, lower=False, size=None):
+    if file.endswith(SUFFIX):
+        return CompiledDict(file, lower, size)
+    output = DictCompiler.compiled_path(file)
+    if DictCompiler.is_stale(file, output):
+        DictCompiler.compile(file, output)
+    return CompiledDict(output, lower, size)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="compile text dictionaries into the mmap format")
+    parser.add_argument("files", nargs="+")
+    args = parser.parse_args()
+    for file in args.files:
+        print("Compiled {} -> {}".format(file, DictCompiler.compile(file)))
@@ -0,0 +1,74 @@
+import os
+
+import torch
+import torch.distributed as dist
+
+# torchrun support for the data_augment trainers. Under torchrun every process
+# joins one process group (nccl on GPU, gloo on CPU hosts) and trains a
+# DistributedDataParallel replica on its own shard of the data; launched as a
+# plain script, everything here degrades to single-process no-ops. Host-side
+# counters (LR tokens, dev loss sums) are reduced over a gloo group so that
+# reducing them never waits on a GPU stream.
+#
+#   torchrun --standalone --nproc_per_node 4 model/run.py --train_file ... --dev_file ... --output_model ...
+
+_HOST_GROUP = None
+
+
+def init_distributed(threads=None):
+    """Join the torchrun process group if there is one; returns (rank, world_size, local_rank)."""
+    global _HOST_GROUP
+    if int(os.environ.get("WORLD_SIZE", "1")) <= 1:
+        return 0, 1, 0
+    local_rank = int(os.environ.get("LOCAL_RANK", "0"))
+    if not dist.is_initialized():
+        if torch.cuda.is_available():
+            torch.cuda.set_device(local_rank)
+            dist.init_process_group("nccl")
+            _HOST_GROUP = dist.new_group(backend="gloo")
+        else:
+            dist.init_process_group("gloo")
+            # torchrun defaults OMP_NUM_THREADS to 1; split the cores between the local ranks instead
+            local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", "1"))
+            torch.set_num_threads(threads or max(1, (os.cpu_count() or 1) // local_world_size))
+    return dist.get_rank(), dist.get_world_size(), local_rank
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def unwrap_model(model):
+    # DataParallel / DistributedDataParallel keep the real model in .module
+    return model.module if hasattr(model, "module") else model
+
+
+def all_reduce_host(values):
+    """Sum a list of Python numbers over all ranks."""
+    if not is_distributed():
+        return list(values)
+    tensor = torch.tensor(values, dtype=torch.float64)
+    dist.all_reduce(tensor, group=_HOST_GROUP)
+    return tensor.tolist()
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier(group=_HOST_GROUP)
+
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
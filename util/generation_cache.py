@@ -0,0 +1,147 @@
+import hashlib
+import json
+import os
+import random
+import sqlite3
+import time
+import unicodedata
+
+import torch
+
+# Persistent memo for seq2seq generation (the data_augment mT5 step 3 and the
+# Hinglish test-file generation). An entry is keyed by a hash of the model
+# weights, the normalized input text and the generation kwargs, so reruns
+# after unrelated pipeline changes only send new inputs to the model, while a
+# retrained checkpoint or different decoding settings never see stale outputs.
+# Lookups and inserts are bulk sqlite statements like TransliterationCache;
+# past max_entries the least recently used entries are evicted. Hits only
+# refresh last_used in memory, the refresh is written with the next insert (or
+# on close), so lookups never open a write transaction, and the table is only
+# counted every check_every inserts. Several processes (the step-3 shard
+# workers) may share one file: connections wait up to `timeout` seconds for
+# the write lock, and a write that still loses it backs off and is retried.
+
+DEFAULT_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "dataset", "generation.sqlite")
+SQL_BATCH = 900
+TOUCH_BATCH = 100000
+WRITE_RETRIES = 5
+INSERT = "INSERT OR REPLACE INTO generations (key, output, last_used) VALUES (?, ?, ?)"
+TOUCH = "UPDATE generations SET last_used = ? WHERE key = ?"
+
+
+def weights_fingerprint(model):
+    # sha1 over every tensor of the state dict, in order
+    digest = hashlib.sha1()
+    for name, tensor in model.state_dict().items():
+        digest.update(name.encode("utf8"))
+        digest.update(str(tensor.dtype).encode("utf8"))
+        digest.update(tensor.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+    return digest.hexdigest()
+
+
+def normalize_text(text):
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+class GenerationCache(object):
+    def __init__(self, model_hash, path=DEFAULT_CACHE, max_entries=2000000, timeout=60.0):
+        self.model_hash = model_hash
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.requests = 0
+        self.touched = {}
+        self.inserted = 0
+        self.check_every = max(1, max_entries // 100)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=timeout)
+        self.write([("PRAGMA journal_mode=WAL", None),
+                    ("CREATE TABLE IF NOT EXISTS generations "
+                     "(key TEXT PRIMARY KEY, output TEXT NOT NULL, last_used INTEGER NOT NULL)", None),
+                    ("CREATE INDEX IF NOT EXISTS generations_last_used ON generations (last_used)", None)])
+
+    def key(self, text, generation_kwargs):
+        payload = json.dumps([self.model_hash, normalize_text(text), generation_kwargs], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha1(payload.encode("utf8")).hexdigest()
+
+    def get_many(self, keys):
+        found = {}
+        keys = list(set(keys))
+        for i in range(0, len(keys), SQL_BATCH):
+            chunk = keys[i : i + SQL_BATCH]
+            query = "SELECT key, output FROM generations WHERE key IN ({})".format(",".join("?" * len(chunk)))
+            found.update(self.conn.execute(query, chunk))
+        self.touched.update(dict.fromkeys(found, time.time_ns()))
+        if len(self.touched) >= TOUCH_BATCH:
+            self.flush()
+        return found
+
+    def write(self, statements):
+        # (sql, rows) pairs in one transaction, rows None for a single statement
+        for attempt in range(WRITE_RETRIES):
+            try:
+                with self.conn:
+                    for sql, rows in statements:
+                        if rows is None:
+                            self.conn.execute(sql)
+                        else:
+                            self.conn.executemany(sql, rows)
+                return
+            except sqlite3.OperationalError as e:
+                if "locked" not in str(e) or attempt == WRITE_RETRIES - 1:
+                    raise
+                time.sleep(random.uniform(1, 2) * 2 ** attempt)
+
+    def touched_rows(self):
+        return [(t, k) for k, t in self.touched.items()]
+
+    def flush(self):
+        if self.touched:
+            self.write([(TOUCH, self.touched_rows())])
+            self.touched = {}
+
+    def put_many(self, pairs):
+        now = time.time_ns()
+        rows = [(k, v, now) for k, v in pairs]
+        self.write([(INSERT, rows), (TOUCH, self.touched_rows())])
+        self.touched = {}
+        self.inserted += len(rows)
+        if self.inserted >= self.check_every:
+            self.inserted = 0
+            self.evict()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM generations").fetchone()[0]
+
+    def evict(self):
+        # trim to max_entries once the table is 10% over, so eviction stays off the common path
+        excess = len(self) - self.max_entries
+        if excess > self.max_entries // 10:
+            self.write([("DELETE FROM generations WHERE key IN "
+                         "(SELECT key FROM generations ORDER BY last_used LIMIT ?)", [(excess,)])])
+
+    def hit_rate(self):
+        return self.hits / max(self.requests, 1)
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+def generate_cached(cache, texts, generation_kwargs, generate_fn):
+    # outputs for texts in order; only the misses (once each) reach generate_fn
+    if cache is None:
+        return generate_fn(texts)
+    keys = [cache.key(text, generation_kwargs) for text in texts]
+    found = cache.get_many(keys)
+    missing = {}
+    for key, text in zip(keys, texts):
+        if key not in found and key not in missing:
+            missing[key] = text
+    cache.requests += len(texts)
+    cache.hits += sum(key in found for key in keys)
+    if missing:
+        new = dict(zip(missing, generate_fn(list(missing.values()))))
+        cache.put_many(new.items())
+        found.update(new)
+    return [found[key] for key in keys]
@@ -0,0 +1,38 @@
+import queue
+import threading
+
+import torch
+
+# Deferred training metrics for the data_augment trainers. The training loop
+# hands over detached on-device tensors every K steps; a daemon thread turns
+# them into Python floats (the only place a device sync happens) and writes
+# them to the SummaryWriter, so the loop itself never blocks on .item().
+
+
+class AsyncScalarWriter(object):
+    def __init__(self, writer=None):
+        self.writer = writer
+        self.last = {}
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._drain, daemon=True)
+        self.thread.start()
+
+    def _drain(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            step, scalars = record
+            values = {tag: value.item() if torch.is_tensor(value) else value for tag, value in scalars.items()}
+            if self.writer is not None:
+                for tag, value in values.items():
+                    self.writer.add_scalar(tag, value, step)
+            self.last = values
+
+    def add_scalars(self, step, scalars):
+        # tensors must not be modified in place afterwards
+        self.queue.put((step, scalars))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
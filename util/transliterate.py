@@ -0,0 +1,82 @@
+import os
+import sqlite3
+
+from indic_transliteration import sanscript
+
+# Devanagari -> ITRANS romanization with a persistent sqlite memo. Each unique
+# form is transliterated once, in a process pool when there are many misses,
+# and every later run (or any other loader) reads it back from disk. The same
+# store backs the Panlex dictionary build, romanize_hindi and the mT5 step-1
+# CodeswitchDataset.
+
+DEFAULT_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "dataset", "transliteration.sqlite")
+SQL_BATCH = 900
+
+
+def romanize(text):
+    return sanscript.transliterate(text, sanscript.DEVANAGARI, sanscript.ITRANS)
+
+
+class TransliterationCache(object):
+    def __init__(self, path=DEFAULT_CACHE, table="devanagari_itrans"):
+        self.path = path
+        self.table = table
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS {} (src TEXT PRIMARY KEY, dst TEXT NOT NULL)".format(table))
+
+    def get_many(self, texts):
+        found = {}
+        texts = list(texts)
+        for i in range(0, len(texts), SQL_BATCH):
+            chunk = texts[i : i + SQL_BATCH]
+            query = "SELECT src, dst FROM {} WHERE src IN ({})".format(self.table, ",".join("?" * len(chunk)))
+            found.update(self.conn.execute(query, chunk))
+        return found
+
+    def put_many(self, pairs):
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO {} (src, dst) VALUES (?, ?)".format(self.table), pairs)
+
+    def close(self):
+        self.conn.close()
+
+
+def romanize_many(texts, cache=None, pool=None, chunksize=256):
+    # returns {text: romanized} for the unique texts given; misses go to the pool if one is passed
+    unique = set(texts)
+    found = cache.get_many(unique) if cache is not None else {}
+    missing = [t for t in unique if t not in found]
+    if missing:
+        if pool is None or len(missing) < chunksize:
+            results = [romanize(t) for t in missing]
+        else:
+            results = pool.map(romanize, missing, chunksize=chunksize)
+        new = dict(zip(missing, results))
+        if cache is not None:
+            cache.put_many(new.items())
+        found.update(new)
+    return found
+
+
+class Transliterator(object):
+    # batch front-end over the shared cache, with a small in-process map for repeats
+    def __init__(self, cache_path=DEFAULT_CACHE, pool=None):
+        self.cache = TransliterationCache(cache_path)
+        self.pool = pool
+        self.memo = {}
+
+    def romanize_batch(self, texts):
+        texts = list(texts)
+        missing = [t for t in texts if t not in self.memo]
+        if missing:
+            self.memo.update(romanize_many(missing, self.cache, self.pool))
+        return [self.memo[t] for t in texts]
+
+    def romanize(self, text):
+        return self.romanize_batch([text])[0]
+
+    def close(self):
+        self.memo = {}
+        self.cache.close()